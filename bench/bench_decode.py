@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+CPU and memory of decoding one bulk poll worth of Flair responses.
+
+Builds the structures, rooms, pucks and vents pages a bulk poll of a
+synthetic home downloads (include and sparse fields as the node server asks
+for them) and times Client.handle_resp over them for each JSON backend
+installed.
+
+    python3 bench/bench_decode.py --devices 1000 --iterations 20
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from mock_flair import SyntheticHome  # noqa: E402
+import flair_api  # noqa: E402
+
+INCLUDES = {'pucks': ['current-reading'], 'vents': ['current-reading']}
+
+
+class CannedResponse(object):
+    def __init__(self, content):
+        self.status_code = 200
+        self.headers = {}
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf8')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def poll_bodies(home, page_size):
+    bodies = []
+    for type_ in ('structures', 'rooms', 'pucks', 'vents'):
+        resources = home.collection(type_)
+        for start in range(0, len(resources), page_size):
+            page = resources[start:start + page_size]
+            body = {'data': page, 'meta': {}}
+            if type_ in INCLUDES:
+                body['included'] = home.included(page, INCLUDES[type_])
+            bodies.append(json.dumps(body).encode('utf8'))
+    return bodies
+
+
+def backends():
+    found = [('json', json.loads)]
+    try:
+        import orjson
+        found.append(('orjson', orjson.loads))
+    except ImportError:
+        pass
+    try:
+        import ujson
+        found.append(('ujson', ujson.loads))
+    except ImportError:
+        pass
+    return found
+
+
+def run(client, bodies, iterations):
+    responses = [CannedResponse(b) for b in bodies]
+    started = time.process_time()
+    for i in range(iterations):
+        models = [client.handle_resp(r) for r in responses]
+    cpu = (time.process_time() - started) / iterations
+
+    tracemalloc.start()
+    models = [client.handle_resp(r) for r in responses]
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del models
+    return cpu, retained, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--page-size', type=int, default=100)
+    args = parser.parse_args()
+
+    rooms = max(1, args.devices // 4)
+    home = SyntheticHome(1, rooms, 3, 1)
+    bodies = poll_bodies(home, args.page_size)
+    print('%d responses, %d KiB per poll' %
+          (len(bodies), sum(len(b) for b in bodies) // 1024))
+    print('%10s %14s %14s %14s' % ('backend', 'cpu_ms/poll', 'retained_kib',
+                                   'peak_kib'))
+    for name, loads in backends():
+        client = flair_api.Client(client_id='bench',
+                                  client_secret='bench',
+                                  api_root='http://localhost/',
+                                  json_loads=loads)
+        cpu, retained, peak = run(client, bodies, args.iterations)
+        print('%10s %14.2f %14d %14d' % (name, cpu * 1000,
+                                         retained // 1024, peak // 1024))
+
+
+if __name__ == '__main__':
+    main()
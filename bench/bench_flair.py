@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark of Flair discovery and polling against bench/mock_flair.
+
+For each home size it runs Controller._discovery_process and a few
+Controller.update polls through a stand-in Polyglot interface and reports
+wall time, request count and peak Python memory.
+
+    python3 bench/bench_flair.py --sizes 10 100 1000 --latency 0.02
+"""
+
+import argparse
+import os
+import queue
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+# flair_poly reads server.json and profile/ relative to the working directory
+os.chdir(ROOT)
+
+from mock_flair import MockFlairServer, SyntheticHome  # noqa: E402
+import flair_poly  # noqa: E402
+
+
+class BenchPolyglot(object):
+    """Just enough of polyinterface.Interface to drive a Controller."""
+
+    def __init__(self):
+        self.inQueue = queue.Queue()
+        self.config = {'nodes': []}
+        self.messages = 0
+
+    def onConfig(self, callback):
+        pass
+
+    def onStop(self, callback):
+        pass
+
+    def send(self, message):
+        self.messages = self.messages + 1
+
+    def addNode(self, node):
+        pass
+
+    def delNode(self, address):
+        pass
+
+    def saveCustomData(self, data):
+        pass
+
+    def installprofile(self):
+        pass
+
+
+def make_controller(server, params):
+    controller = flair_poly.Controller(BenchPolyglot())
+    customParams = {'client_id': 'bench', 'client_secret': 'bench',
+                    'api_root': server.url, 'discovery_cache': 'false',
+                    'metrics_log': 'false'}
+    customParams.update(params)
+    controller.polyConfig = {'customParams': customParams,
+                             'customData': {}, 'nodes': []}
+    controller.discover = lambda *args, **kwargs: None
+    controller.start()
+    return controller
+
+
+def home_shape(devices, vents, pucks):
+    perRoom = vents + pucks
+    return max(1, devices // perRoom)
+
+
+def run(size, args, params):
+    rooms = home_shape(size, args.vents, args.pucks)
+    home = SyntheticHome(args.structures, max(1, rooms // args.structures),
+                         args.vents, args.pucks)
+    server = MockFlairServer(home, latency=args.latency, jitter=args.jitter,
+                             error_rate=args.error_rate,
+                             page_size=args.page_size,
+                             validators=not args.no_validators).start()
+    try:
+        controller = make_controller(server, params)
+
+        tracemalloc.start()
+        started = time.time()
+        controller._discovery_process()
+        discoverySeconds = time.time() - started
+        discoveryRequests = server.total_requests()
+        _, discoveryPeak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        pollSeconds = []
+        pollRequests = []
+        pollBytes = []
+        tracemalloc.start()
+        for i in range(args.polls):
+            server.reset_counts()
+            started = time.time()
+            controller.update()
+            pollSeconds.append(time.time() - started)
+            pollRequests.append(server.total_requests())
+            pollBytes.append(server.bytes_sent)
+        _, pollPeak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        controller.stop()
+        return {
+            'devices': len(home.collection('vents')) +
+            len(home.collection('pucks')),
+            'nodes': len(controller.nodes) - 1,
+            'discovery_s': discoverySeconds,
+            'discovery_req': discoveryRequests,
+            'discovery_kib': discoveryPeak / 1024.0,
+            'poll_s': sum(pollSeconds) / len(pollSeconds),
+            'poll_req': sum(pollRequests) / float(len(pollRequests)),
+            'poll_kib_rx': sum(pollBytes) / 1024.0 / len(pollBytes),
+            'poll_kib': pollPeak / 1024.0
+        }
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--structures', type=int, default=1)
+    parser.add_argument('--vents', type=int, default=3)
+    parser.add_argument('--pucks', type=int, default=1)
+    parser.add_argument('--polls', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--no-validators', action='store_true',
+                        help='mock server sends no ETag')
+    parser.add_argument('--param', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='controller custom parameter, e.g. '
+                             'poll_mode=node, may be repeated')
+    args = parser.parse_args()
+    # polyinterface redirects sys.stdout into its log
+    out = sys.__stdout__
+    params = dict(p.split('=', 1) for p in args.param)
+
+    columns = ['devices', 'nodes', 'discovery_s', 'discovery_req',
+               'discovery_kib', 'poll_s', 'poll_req', 'poll_kib_rx', 'poll_kib']
+    print(' '.join('%13s' % c for c in columns), file=out)
+    for size in args.sizes:
+        result = run(size, args, params)
+        print(' '.join('%13.3f' % result[c] if isinstance(result[c], float)
+                       else '%13d' % result[c] for c in columns),
+              file=out)
+        out.flush()
+
+
+if __name__ == '__main__':
+    main()
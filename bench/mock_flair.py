@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for api.flair.co serving a synthetic home over JSON:API.
+
+Serves /oauth/token, the /api/ links, collections with meta.next paging and
+include=, single resources, relationships and PATCH. Latency and error
+injection are configurable so client and poller changes can be compared
+offline.
+
+    python3 bench/mock_flair.py --structures 1 --rooms 25 --vents 3 --pucks 1
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlencode, urlparse, parse_qs
+except ImportError:
+    raise SystemExit('mock_flair requires Python 3.7+')
+
+READING_TYPES = {'vents': 'vent-readings', 'pucks': 'sensor-readings'}
+
+
+class SyntheticHome(object):
+    """In-memory JSON:API documents for structures x rooms x vents/pucks."""
+
+    def __init__(self, structures=1, rooms=4, vents=2, pucks=1):
+        self.db = {}
+        self.lock = threading.Lock()
+        roomId = ventId = puckId = 0
+        for s in range(1, structures + 1):
+            roomIds = []
+            structureVents = []
+            structurePucks = []
+            for r in range(rooms):
+                roomId = roomId + 1
+                roomIds.append(roomId)
+                ventIds = []
+                puckIds = []
+                for v in range(vents):
+                    ventId = ventId + 1
+                    ventIds.append(ventId)
+                    self._add('vent-readings', ventId, {
+                        'duct-pressure': 1.0 + random.random(),
+                        'duct-temperature-c': 20 + random.random() * 5,
+                        'rssi': -60
+                    }, {})
+                    self._add('vents', ventId, {
+                        'name': 'Vent %d' % ventId,
+                        'inactive': False,
+                        'percent-open': 100,
+                        'voltage': 2.9
+                    }, {'current-reading': ('vent-readings', ventId),
+                        'room': ('rooms', roomId)})
+                for p in range(pucks):
+                    puckId = puckId + 1
+                    puckIds.append(puckId)
+                    self._add('sensor-readings', puckId, {
+                        'rssi': -55,
+                        'system-voltage': 3.0
+                    }, {})
+                    self._add('pucks', puckId, {
+                        'name': 'Puck %d' % puckId,
+                        'inactive': False,
+                        'current-temperature-c': 21.0,
+                        'current-humidity': 40
+                    }, {'current-reading': ('sensor-readings', puckId),
+                        'room': ('rooms', roomId)})
+                structureVents.extend(ventIds)
+                structurePucks.extend(puckIds)
+                self._add('rooms', roomId, {
+                    'name': 'Room %d' % roomId,
+                    'active': True,
+                    'current-temperature-c': 21.0,
+                    'current-humidity': 40,
+                    'set-point-c': 21.0
+                }, {'vents': [('vents', i) for i in ventIds],
+                    'pucks': [('pucks', i) for i in puckIds],
+                    'structure': ('structures', s)})
+            self._add('structures', s, {
+                'name': 'Home %d' % s,
+                'is-active': True,
+                'set-point-temperature-c': 21,
+                'home': True,
+                'set-point-mode':
+                    'Home Evenness For Active Rooms Flair Setpoint',
+                'home-away-mode': 'Manual',
+                'mode': 'manual'
+            }, {'rooms': [('rooms', i) for i in roomIds],
+                'vents': [('vents', i) for i in structureVents],
+                'pucks': [('pucks', i) for i in structurePucks]})
+
+    def _add(self, type_, id_, attributes, relationships):
+        rels = {}
+        for rel, linkage in relationships.items():
+            if isinstance(linkage, list):
+                data = [{'type': t, 'id': str(i)} for t, i in linkage]
+            else:
+                data = {'type': linkage[0], 'id': str(linkage[1])}
+            rels[rel] = {
+                'links': {
+                    'self': '/api/%s/%s/relationships/%s' % (type_, id_, rel),
+                    'related': '/api/%s/%s/%s' % (type_, id_, rel)
+                },
+                'data': data
+            }
+        self.db[(type_, str(id_))] = {
+            'type': type_,
+            'id': str(id_),
+            'attributes': attributes,
+            'relationships': rels
+        }
+
+    def types(self):
+        return sorted(set(t for t, i in self.db))
+
+    def collection(self, type_):
+        return [r for (t, i), r in sorted(self.db.items(),
+                                           key=lambda item: int(item[0][1]))
+                if t == type_]
+
+    def get(self, type_, id_):
+        return self.db.get((type_, id_))
+
+    def related(self, type_, id_, rel):
+        resource = self.get(type_, id_)
+        if resource is None or rel not in resource['relationships']:
+            return None
+        data = resource['relationships'][rel]['data']
+        if isinstance(data, list):
+            return [self.db[(d['type'], d['id'])] for d in data]
+        return self.db[(data['type'], data['id'])]
+
+    def included(self, resources, include):
+        seen = {}
+        for rel in include:
+            for resource in resources:
+                linkage = resource['relationships'].get(rel, {}).get('data')
+                for d in linkage if isinstance(linkage, list) else [linkage]:
+                    if d:
+                        seen[(d['type'], d['id'])] = self.db[(d['type'],
+                                                              d['id'])]
+        return list(seen.values())
+
+    def patch(self, type_, id_, attributes):
+        with self.lock:
+            resource = self.get(type_, id_)
+            if resource is not None:
+                resource['attributes'].update(attributes)
+            return resource
+
+
+class MockFlairServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, home, host='127.0.0.1', port=0, latency=0.0,
+                 jitter=0.0, error_rate=0.0, page_size=100, validators=True):
+        ThreadingHTTPServer.__init__(self, (host, port), MockFlairHandler)
+        self.home = home
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.validators = validators
+        self.counts = {}
+        self.bytes_sent = 0
+        self.count_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server_address
+
+    def count(self, key):
+        with self.count_lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def sent(self, nbytes):
+        with self.count_lock:
+            self.bytes_sent = self.bytes_sent + nbytes
+
+    def total_requests(self):
+        with self.count_lock:
+            return sum(self.counts.values())
+
+    def reset_counts(self):
+        with self.count_lock:
+            self.counts = {}
+            self.bytes_sent = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class MockFlairHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode('utf8') if body is not None \
+            else b''
+        headers = dict(headers or {})
+        if self.command == 'GET' and status == 200 and self.server.validators:
+            etag = '"%s"' % hashlib.sha1(payload).hexdigest()[:16]
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                status = 304
+                payload = b''
+        self.server.sent(len(payload))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/vnd.api+json')
+        self.send_header('Content-Length', str(len(payload)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _inject(self):
+        server = self.server
+        delay = server.latency + random.random() * server.jitter
+        if delay:
+            time.sleep(delay)
+        if server.error_rate and random.random() < server.error_rate:
+            self._send(503, {'errors': [{'status': '503'}]},
+                       {'Retry-After': '0'})
+            return True
+        return False
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self._read_body()
+        self.server.count('POST ' + url.path)
+        if self._inject():
+            return
+        if url.path == '/oauth/token':
+            return self._send(200, {'access_token': 'mock-token',
+                                    'token_type': 'Bearer',
+                                    'expires_in': 3600})
+        self._send(404, {'errors': [{'status': '404'}]})
+
+    def do_PATCH(self):
+        url = urlparse(self.path)
+        body = json.loads(self._read_body() or b'{}')
+        self.server.count('PATCH ' + url.path)
+        if self._inject():
+            return
+        parts = url.path.strip('/').split('/')[1:]
+        if len(parts) == 2:
+            resource = self.server.home.patch(
+                parts[0], parts[1],
+                body.get('data', {}).get('attributes', {})
+            )
+            if resource is not None:
+                return self._send(200, {'data': resource})
+        self._send(404, {'errors': [{'status': '404'}]})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.server.count('GET ' + url.path)
+        if self._inject():
+            return
+        home = self.server.home
+        if url.path == '/api/' or url.path == '/api':
+            return self._send(200, {'links': {
+                t: {'self': '/api/' + t, 'type': t} for t in home.types()
+            }})
+        if self.headers.get('Authorization') != 'Bearer mock-token':
+            return self._send(401, {'errors': [{'status': '401'}]})
+
+        parts = url.path.strip('/').split('/')[1:]
+        include = [i for i in query.get('include', '').split(',') if i]
+        if len(parts) == 1:
+            resources = home.collection(parts[0])
+            page = int(query.get('page', 1))
+            size = self.server.page_size
+            data = resources[(page - 1) * size:page * size]
+            meta = {}
+            if page * size < len(resources):
+                query['page'] = page + 1
+                meta['next'] = '/api/%s?%s' % (parts[0], urlencode(query))
+            body = {'data': data, 'meta': meta}
+        elif len(parts) == 2:
+            data = home.get(parts[0], parts[1])
+            if data is None:
+                return self._send(404, {'errors': [{'status': '404'}]})
+            body = {'data': data, 'meta': {}}
+        elif len(parts) == 3:
+            data = home.related(parts[0], parts[1], parts[2])
+            if data is None:
+                return self._send(404, {'errors': [{'status': '404'}]})
+            body = {'data': data, 'meta': {}}
+        else:
+            return self._send(404, {'errors': [{'status': '404'}]})
+        if include:
+            body['included'] = home.included(
+                data if isinstance(data, list) else [data], include
+            )
+        self._send(200, body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--structures', type=int, default=1)
+    parser.add_argument('--rooms', type=int, default=4)
+    parser.add_argument('--vents', type=int, default=2)
+    parser.add_argument('--pucks', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--no-validators', action='store_true',
+                        help='send no ETag and ignore If-None-Match')
+    args = parser.parse_args()
+
+    home = SyntheticHome(args.structures, args.rooms, args.vents, args.pucks)
+    server = MockFlairServer(home, port=args.port, latency=args.latency,
+                             jitter=args.jitter, error_rate=args.error_rate,
+                             page_size=args.page_size,
+                             validators=not args.no_validators)
+    print('Mock Flair API on ' + server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import hashlib
+import re
+
+# Node addresses are kept within the 12 characters the name hashes used
+MAX_ADDRESS_LENGTH = 12
+TYPE_PREFIXES = {
+    'structures': 's',
+    'rooms': 'r',
+    'pucks': 'p',
+    'vents': 'v'
+}
+
+
+def resource_address(type_, id_):
+    """Address derived from the immutable Flair type and id."""
+    prefix = TYPE_PREFIXES.get(type_, 'x')
+    ident = str(id_).lower()
+    if not re.match('^[a-z0-9]+$', ident) or \
+       len(prefix) + len(ident) > MAX_ADDRESS_LENGTH:
+        ident = hashlib.sha1(str(id_).encode('utf8')).hexdigest()
+    return (prefix + ident)[:MAX_ADDRESS_LENGTH]
+
+
+def legacy_address(name, room_name=None):
+    """Address the node server gave before addresses were id based."""
+    address = str(int(hashlib.md5(name.encode('utf8')).hexdigest(), 16) %
+                  (10 ** 8))
+    if room_name is not None:
+        address = legacy_address(room_name)[:4] + address
+    return address
+
+
+def book_key(type_, id_):
+    return type_ + ':' + str(id_)
+
+
+class AddressBook(object):
+    """Persisted Flair resource id to node address table.
+
+    Existing installs keep the name based address their ISY programs point
+    at, new resources get an id based address. The reverse table keeps
+    two resources from being given the same address.
+    """
+
+    def __init__(self, entries=None):
+        self.addresses = dict(entries or {})
+        self.keys = {a: k for k, a in self.addresses.items()}
+        self.changed = False
+
+    def assign(self, type_, id_, legacy=None, known=()):
+        """Returns the address of a resource, assigning one if needed.
+
+        legacy is a callable returning the address the old naming scheme
+        would give, it is adopted when Polyglot already knows that address
+        and no other resource claimed it.
+        """
+        key = book_key(type_, id_)
+        address = self.addresses.get(key)
+        if address is not None:
+            return address
+        address = None
+        if legacy is not None:
+            candidate = legacy()
+            if candidate in known and candidate not in self.keys:
+                address = candidate
+        if address is None:
+            address = resource_address(type_, id_)
+            if address in self.keys:
+                # Truncated hash clash, fall back to a hash of the full key
+                address = resource_address(type_, key)
+        self.addresses[key] = address
+        self.keys[address] = key
+        self.changed = True
+        return address
+
+    def bind(self, type_, id_, address):
+        """Records the address an existing node already uses."""
+        key = book_key(type_, id_)
+        if self.addresses.get(key) == address:
+            return
+        self.keys.pop(self.addresses.get(key), None)
+        self.addresses[key] = address
+        self.keys[address] = key
+        self.changed = True
+
+    def to_dict(self):
+        return dict(self.addresses)
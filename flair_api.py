@@ -1,15 +1,110 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from urllib.parse import urljoin, urlparse
+except ImportError:
+    from urlparse import urljoin, urlparse
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 try:
-    from urllib.parse import urljoin
+    from sys import intern
 except ImportError:
-    from urlparse import urljoin
+    pass
+
+# orjson is used when it is installed, it takes about half the time of the
+# stdlib decoder on a poll but building the models dominates handle_resp,
+# see bench/bench_decode.py
+try:
+    import orjson
+    DEFAULT_JSON_LOADS = orjson.loads
+except ImportError:
+    DEFAULT_JSON_LOADS = json.loads
 
 DEFAULT_CLIENT_HEADERS = {
     'Accept': 'application/vnd.api+json',
     'Content-Type': 'application/json'
 }
 
+DEFAULT_POOL_SIZE = 10
+# (connect, read) timeouts in seconds, passed to every request
+DEFAULT_TIMEOUT = (5, 30)
+# Renew the token this many seconds before it expires
+DEFAULT_TOKEN_MARGIN = 120
+# The /api/ links hardly ever change
+DEFAULT_API_ROOT_TTL = 24 * 60 * 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PATCH', 'PUT', 'DELETE')
+# Parsed GET responses kept by a Client, 0 disables the cache
+DEFAULT_CACHE_SIZE = 0
+# Seconds a response without ETag or Last-Modified is reused
+DEFAULT_CACHE_TTL = 5
+# Requests failing in a row before the circuit breaker opens, 0 disables it
+DEFAULT_BREAKER_THRESHOLD = 5
+# Seconds the circuit stays open before a probe, doubled after each failed
+# probe up to the max
+DEFAULT_BREAKER_RESET = 30
+DEFAULT_BREAKER_MAX_RESET = 300
+
+
+def make_session(pool_size=DEFAULT_POOL_SIZE, keep_alive=True):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def parse_retry_after(resp):
+    value = resp.headers.get('Retry-After') if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0, mktime_tz(parsed) - time.time())
+
+
+def endpoint_name(method, url):
+    """GET /api/vents/:id/current-reading style key for metrics."""
+    parts = [':id' if re.search('[0-9]', p) else p
+             for p in urlparse(url).path.split('/')]
+    return method + ' ' + '/'.join(parts)
+
+
+def jsonapi_params(include=None, fields=None, **params):
+    """Turns include=[...] and fields={type: [...]} into JSON:API params."""
+    if include:
+        params['include'] = include if isinstance(include, str) \
+            else ','.join(include)
+    for type_, names in (fields or {}).items():
+        params['fields[' + type_ + ']'] = names if isinstance(names, str) \
+            else ','.join(names)
+    return params
+
+
+def request_key(url, params):
+    return (url, tuple(sorted((params or {}).items())))
+
 
 def relationship_data(data):
     return [m.to_relationship() for m in data] \
@@ -25,6 +120,15 @@ class EmptyBodyException(Exception):
             str(self.status_code) + ">"
 
 
+class CircuitOpenError(Exception):
+    def __init__(self, retry_in):
+        self.retry_in = retry_in
+
+    def __str__(self):
+        return self.__class__.__name__ + "<Flair API unreachable, " + \
+            "next probe in %.0fs>" % self.retry_in
+
+
 class ApiError(Exception):
     def __init__(self, resp):
         self.status_code = resp.status_code
@@ -40,14 +144,33 @@ class ApiError(Exception):
 
 
 class Relationship(object):
+    __slots__ = ('client', 'rel', 'self_href', 'related_href', 'data',
+                 'resolved')
+
     def __init__(self, rel, client, rel_data):
         self.client = client
         self.rel = rel
         self.self_href = rel_data.get('links', {}).get('self', '')
         self.related_href = rel_data.get('links', {}).get('related', '')
         self.data = rel_data.get('data', {})
+        self.resolved = None
+
+    def resolve(self, included):
+        # Point at the related resources when the compound document
+        # carried all of them, get() then needs no request.
+        data = self.data
+        if isinstance(data, list):
+            keys = [(d.get('type'), d.get('id')) for d in data]
+            if keys and all(k in included for k in keys):
+                self.resolved = self.client.collection_class(
+                    self.client, {}, keys[0][0], [included[k] for k in keys]
+                )
+        elif data and (data.get('type'), data.get('id')) in included:
+            self.resolved = included[(data.get('type'), data.get('id'))]
 
     def get(self, **params):
+        if self.resolved is not None and not params:
+            return self.resolved
         return self.client.get_url(self.related_href, **params)
 
     def add(self, data):
@@ -69,6 +192,86 @@ class Relationship(object):
         self.client.delete_url(self.self_href, dict(data=rel_form))
 
 
+class RelationshipMap(Mapping):
+    """{rel: Relationship} building each Relationship on first access.
+
+    Resources carry a handful of relationships of which callers use one
+    or two, until then each is kept as a (self, related, data) tuple.
+    """
+    __slots__ = ('client', 'relationship_class', 'raw')
+
+    def __init__(self, client, relationship_class, raw):
+        self.client = client
+        self.relationship_class = relationship_class
+        self.raw = {}
+        for rel, rel_data in raw.items():
+            links = rel_data.get('links', {})
+            self.raw[intern(rel)] = (links.get('self', ''),
+                                     links.get('related', ''),
+                                     rel_data.get('data', {}))
+
+    def resolve(self, included):
+        # Relationships the compound document carried are built now and
+        # point at the included resources, the others stay lazy
+        for rel in list(self.raw):
+            entry = self.raw[rel]
+            if isinstance(entry, tuple):
+                data = entry[2]
+                keys = [(d.get('type'), d.get('id'))
+                        for d in (data if isinstance(data, list) else [data])
+                        if d]
+                if not any(k in included for k in keys):
+                    continue
+                entry = self[rel]
+            entry.resolve(included)
+
+    def __getitem__(self, rel):
+        entry = self.raw[rel]
+        if not isinstance(entry, tuple):
+            return entry
+        self_href, related_href, data = entry
+        relationship = self.relationship_class(rel, self.client, {
+            'links': {'self': self_href, 'related': related_href},
+            'data': data
+        })
+        self.raw[rel] = relationship
+        return relationship
+
+    def __contains__(self, rel):
+        return rel in self.raw
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+
+class _Prefetch(threading.Thread):
+    """Fetches a URL in the background until result() is called."""
+
+    def __init__(self, client, url):
+        super(_Prefetch, self).__init__()
+        self.daemon = True
+        self.client = client
+        self.url = url
+        self.value = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.client.get_url(self.url)
+        except Exception as ex:
+            self.error = ex
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
 class ResourceCollection(object):
     def __init__(self, client, meta, type_, resources):
         self.client = client
@@ -79,9 +282,14 @@ class ResourceCollection(object):
     def load_next_page(self):
         if self.meta.get('next'):
             col = self.client.get_url(self.meta['next'])
-            self.resources = self.resources + col.resources
+            self.resources.extend(col.resources)
             self.meta = col.meta
 
+    def load_all(self):
+        while self.meta.get('next'):
+            self.load_next_page()
+        return self
+
     def __getitem__(self, idx):
         return self.resources[idx]
 
@@ -94,11 +302,38 @@ class ResourceCollection(object):
 
     def all(self):
         idx = 0
-        while self.meta.get('next'):
-            if self[idx] == self.resources[-1]:
-                self.load_next_page()
-            yield self[idx]
-            idx = idx + 1
+        while True:
+            while idx < len(self.resources):
+                yield self.resources[idx]
+                idx = idx + 1
+            if not self.meta.get('next'):
+                return
+            self.load_next_page()
+
+    def pages(self, prefetch=False):
+        """Yields this page then each following one without keeping them.
+
+        With prefetch the next page is requested in the background while
+        the caller works through the current one.
+        """
+        page = self
+        while page is not None:
+            next_url = page.meta.get('next')
+            fetch = _Prefetch(self.client, next_url) \
+                if next_url and prefetch else None
+            yield page
+            if not next_url:
+                return
+            try:
+                page = fetch.result() if fetch is not None \
+                    else self.client.get_url(next_url)
+            except EmptyBodyException:
+                return
+
+    def stream(self, prefetch=False):
+        for page in self.pages(prefetch):
+            for r in page.resources:
+                yield r
 
     def up_to(self, limit):
         while len(self.resources) < limit and self.meta.get('next'):
@@ -107,13 +342,30 @@ class ResourceCollection(object):
 
 
 class Resource(object):
+    __slots__ = ('client', 'id_', 'type_', 'attributes', 'relationships',
+                 'deleted')
+    relationship_class = Relationship
+    # Attribute and relationship names kept, None keeps them all
+    kept_fields = None
+
     def __init__(self, client, id_, type_, attributes, relationships):
         self.client = client
         self.id_ = id_
-        self.type_ = type_
+        self.type_ = intern(type_) if type_ is not None else None
+        # Interned keys are shared by every resource instead of each
+        # response allocating its own copy of 'current-temperature-c'
+        kept = self.kept_fields
+        if kept is not None:
+            attributes = {intern(k): v for k, v in attributes.items()
+                          if k in kept}
+            relationships = {k: v for k, v in relationships.items()
+                             if k in kept}
+        else:
+            attributes = {intern(k): v for k, v in attributes.items()}
         self.attributes = attributes
-        self.relationships = {rel: Relationship(rel, self.client, data)
-                              for rel, data in relationships.items()}
+        self.relationships = RelationshipMap(
+            client, self.relationship_class, relationships
+        )
         self.deleted = False
 
     def __eq__(self, other):
@@ -122,8 +374,11 @@ class Resource(object):
     def to_relationship(self):
         return {"id": self.id_, "type": self.type_}
 
-    def get_self(self):
-        resp = self.client.get(self.type_, id=self.id_)
+    def resolve_included(self, included):
+        self.relationships.resolve(included)
+
+    def get_self(self, **params):
+        resp = self.client.get(self.type_, id=self.id_, **params)
         self.attributes = resp.attributes
         self.relationships = resp.relationships
         return self
@@ -156,51 +411,547 @@ class Resource(object):
             self.relationships[rel].delete(val)
 
 
+def restricted_model(fields, base=Resource):
+    """Model class for a mapper keeping only the given field names."""
+    return type(base.__name__, (base,), {
+        '__slots__': (),
+        'kept_fields': frozenset(fields)
+    })
+
+
+class RetryPolicy(object):
+    """Exponential backoff with full jitter, bounded per request.
+
+    A request is retried at most max_retries times and never sleeps more
+    than budget seconds in total. Connection errors are only retried for
+    idempotent methods, a 429 is retried for any method. A Retry-After
+    longer than max_backoff or the remaining budget is honoured by not
+    retrying, the response is returned to the caller instead.
+    """
+
+    def __init__(self,
+                 max_retries=3,
+                 backoff=0.5,
+                 max_backoff=30,
+                 budget=60,
+                 statuses=RETRY_STATUSES):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.statuses = statuses
+
+    def should_retry(self, method, attempt, resp=None, error=None):
+        if attempt >= self.max_retries:
+            return False
+        if error is not None:
+            return method in IDEMPOTENT_METHODS
+        if resp.status_code == 429:
+            return True
+        return resp.status_code in self.statuses and \
+            method in IDEMPOTENT_METHODS
+
+    def delay(self, attempt, resp=None):
+        """Seconds to wait before the next attempt, None to give up."""
+        retry_after = parse_retry_after(resp)
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_backoff else None
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * (2 ** attempt))
+        )
+
+
+class CircuitBreaker(object):
+    """Fails requests fast while the API is unreachable.
+
+    After failure_threshold requests in a row get no response or a 5xx,
+    retries included, the circuit opens and requests raise
+    CircuitOpenError without being sent. Once reset_timeout seconds have
+    passed a single request goes through as a probe, its success closes
+    the circuit and its failure opens it again for twice as long, up to
+    max_reset_timeout.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self,
+                 failure_threshold=DEFAULT_BREAKER_THRESHOLD,
+                 reset_timeout=DEFAULT_BREAKER_RESET,
+                 max_reset_timeout=DEFAULT_BREAKER_MAX_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max(reset_timeout, max_reset_timeout)
+        self.failures = 0
+        self.opened_at = None
+        self.open_for = reset_timeout
+        self.probe_started = None
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def _state(self, now):
+        if self.opened_at is None:
+            return self.CLOSED
+        if now - self.opened_at < self.open_for:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    @property
+    def state(self):
+        with self.lock:
+            return self._state(time.time())
+
+    def acquire(self):
+        """Returns True when the request is the probe.
+
+        Raises CircuitOpenError while open, and while half open for every
+        request but the probe. A probe that never reported back is replaced
+        after open_for seconds.
+        """
+        with self.lock:
+            now = time.time()
+            state = self._state(now)
+            if state == self.CLOSED:
+                return False
+            if state == self.HALF_OPEN and (
+                    self.probe_started is None or
+                    now - self.probe_started >= self.open_for):
+                self.probe_started = now
+                return True
+            raise CircuitOpenError(
+                max(0, self.opened_at + self.open_for - now)
+            )
+
+    def record(self, success, probe=False):
+        if self.failure_threshold <= 0:
+            return
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                self.open_for = self.reset_timeout
+                self.probe_started = None
+                return
+            self.failures += 1
+            if probe:
+                self.open_for = min(self.max_reset_timeout,
+                                    self.open_for * 2)
+                self.opened_at = time.time()
+                self.probe_started = None
+            elif self.opened_at is None and \
+                    self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+                self.opened += 1
+
+
+class TokenBucket(object):
+    """Client-wide ceiling on requests per minute."""
+
+    def __init__(self, requests_per_minute, capacity=None):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = capacity or max(1.0, requests_per_minute / 6.0)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token and returns how long to wait before using it."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ClientMetrics(object):
+    """Per-endpoint request counters and latency histograms."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def _endpoint(self, name):
+        stats = self.endpoints.get(name)
+        if stats is None:
+            stats = self.endpoints[name] = {
+                'requests': 0,
+                'errors': 0,
+                'retries': 0,
+                'coalesced': 0,
+                'rejected': 0,
+                'bytes': 0,
+                'seconds': 0.0,
+                'buckets': [0] * (len(self.buckets) + 1)
+            }
+        return stats
+
+    def record(self, name, seconds, status_code=None, nbytes=0):
+        """One attempt, status_code is None when no response came back."""
+        with self.lock:
+            stats = self._endpoint(name)
+            stats['requests'] += 1
+            stats['seconds'] += seconds
+            stats['bytes'] += nbytes
+            if status_code is None or status_code >= 400:
+                stats['errors'] += 1
+            idx = 0
+            while idx < len(self.buckets) and seconds > self.buckets[idx]:
+                idx = idx + 1
+            stats['buckets'][idx] += 1
+
+    def record_retry(self, name):
+        with self.lock:
+            self._endpoint(name)['retries'] += 1
+
+    def record_coalesced(self, name):
+        """A GET served by a request already in flight."""
+        with self.lock:
+            self._endpoint(name)['coalesced'] += 1
+
+    def record_rejected(self, name):
+        """A request not sent because the circuit breaker was open."""
+        with self.lock:
+            self._endpoint(name)['rejected'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            endpoints = {name: dict(stats, buckets=list(stats['buckets']))
+                         for name, stats in self.endpoints.items()}
+        totals = {k: sum(e[k] for e in endpoints.values())
+                  for k in ('requests', 'errors', 'retries', 'coalesced',
+                            'rejected', 'bytes', 'seconds')}
+        return {'endpoints': endpoints, 'totals': totals}
+
+    def prometheus_text(self, prefix='flair_api'):
+        lines = []
+        endpoints = self.snapshot()['endpoints']
+        for metric, key in (('requests_total', 'requests'),
+                            ('errors_total', 'errors'),
+                            ('retries_total', 'retries'),
+                            ('coalesced_total', 'coalesced'),
+                            ('rejected_total', 'rejected'),
+                            ('received_bytes_total', 'bytes')):
+            lines.append('# TYPE %s_%s counter' % (prefix, metric))
+            for name, stats in sorted(endpoints.items()):
+                lines.append('%s_%s{endpoint="%s"} %s' %
+                             (prefix, metric, name, stats[key]))
+        lines.append('# TYPE %s_request_seconds histogram' % prefix)
+        for name, stats in sorted(endpoints.items()):
+            count = 0
+            for bound, n in zip(list(self.buckets) + ['+Inf'],
+                                stats['buckets']):
+                count = count + n
+                lines.append('%s_request_seconds_bucket{endpoint="%s",'
+                             'le="%s"} %d' % (prefix, name, bound, count))
+            lines.append('%s_request_seconds_sum{endpoint="%s"} %f' %
+                         (prefix, name, stats['seconds']))
+            lines.append('%s_request_seconds_count{endpoint="%s"} %d' %
+                         (prefix, name, stats['requests']))
+        return '\n'.join(lines) + '\n'
+
+
+class InFlight(object):
+    """A GET other callers wait on instead of sending their own."""
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class CacheEntry(object):
+    __slots__ = ('etag', 'last_modified', 'stored', 'model')
+
+    def __init__(self, etag, last_modified, stored, model):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored = stored
+        self.model = model
+
+    def validators(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache(object):
+    """LRU of parsed GET responses keyed by url and params.
+
+    Entries the server gave an ETag or Last-Modified are revalidated with a
+    conditional request and reused on a 304, entries without validators
+    are reused for ttl seconds without any request.
+    """
+
+    def __init__(self, max_entries=256, ttl=DEFAULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def fresh(self, entry):
+        return not entry.etag and not entry.last_modified and \
+            time.time() - entry.stored < self.ttl
+
+    def store(self, key, resp, model):
+        entry = CacheEntry(resp.headers.get('ETag'),
+                           resp.headers.get('Last-Modified'),
+                           time.time(), model)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'hits': self.hits,
+                    'revalidated': self.revalidated,
+                    'misses': self.misses}
+
+
+class CredentialManager(object):
+    """Tracks token expiry and the cached /api/ links for a Client."""
+
+    def __init__(self,
+                 client,
+                 token_margin=DEFAULT_TOKEN_MARGIN,
+                 api_root_ttl=DEFAULT_API_ROOT_TTL):
+        self.client = client
+        self.token_margin = token_margin
+        self.api_root_ttl = api_root_ttl
+        self.token_expires_at = 0
+        self.api_root_expires_at = 0
+        self.lock = threading.Lock()
+
+    def token_fetched(self, expires_in):
+        if expires_in:
+            self.token_expires_at = time.time() + int(expires_in)
+        else:
+            self.token_expires_at = 0
+
+    def api_root_fetched(self):
+        self.api_root_expires_at = time.time() + self.api_root_ttl
+
+    def token_expired(self):
+        if self.client.token is None:
+            return True
+        # No expires_in from the server, keep the token until a 401
+        if not self.token_expires_at:
+            return False
+        return time.time() >= self.token_expires_at - self.token_margin
+
+    def api_root_expired(self):
+        return self.client.api_root_resp is None or \
+            time.time() >= self.api_root_expires_at
+
+    def invalidate_token(self):
+        with self.lock:
+            self.client.token = None
+
+    def ensure_token(self):
+        with self.lock:
+            if self.token_expired():
+                return self.client.oauth_token()
+
+    def ensure_api_root(self):
+        with self.lock:
+            if self.api_root_expired():
+                return self.client.api_root_response()
+
+
 class Client(object):
+    collection_class = ResourceCollection
+    credentials_class = CredentialManager
+
     def __init__(self,
                  client_id=None,
                  client_secret=None,
                  api_root='https://api-qa.flair.co/',
                  mapper={},
                  admin=False,
-                 default_model=Resource):
+                 default_model=Resource,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 keep_alive=True,
+                 timeout=DEFAULT_TIMEOUT,
+                 session=None,
+                 token_margin=DEFAULT_TOKEN_MARGIN,
+                 api_root_ttl=DEFAULT_API_ROOT_TTL,
+                 retry_policy=None,
+                 requests_per_minute=None,
+                 cache_size=DEFAULT_CACHE_SIZE,
+                 cache_ttl=DEFAULT_CACHE_TTL,
+                 coalesce=True,
+                 json_loads=None,
+                 circuit_breaker=None):
         self.admin = admin
         self.client_id = client_id
         self.client_secret = client_secret
         self.api_root = api_root
         self.mapper = mapper
         self.default_model = default_model
+        self.token = None
+        self.expires_in = None
+        self.api_root_resp = None
+        self.credentials = self.credentials_class(
+            self, token_margin=token_margin, api_root_ttl=api_root_ttl
+        )
+        self.timeout = timeout
+        self.session = session if session is not None else \
+            self.make_session(pool_size, keep_alive)
+        self.retry_policy = retry_policy if retry_policy is not None \
+            else RetryPolicy()
+        self.rate_limiter = TokenBucket(requests_per_minute) \
+            if requests_per_minute else None
+        self.circuit_breaker = circuit_breaker \
+            if circuit_breaker is not None else CircuitBreaker()
+        self.metrics = ClientMetrics()
+        self.cache = ResponseCache(cache_size, cache_ttl) \
+            if cache_size else None
+        self.coalesce = coalesce
+        self.json_loads = json_loads or DEFAULT_JSON_LOADS
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+
+    def make_session(self, pool_size, keep_alive):
+        return make_session(pool_size, keep_alive)
+
+    def _acquire_circuit(self, endpoint):
+        try:
+            return self.circuit_breaker.acquire()
+        except CircuitOpenError:
+            self.metrics.record_rejected(endpoint)
+            raise
+
+    def _should_retry(self, method, attempt, resp, error, probe):
+        # The probe gets one attempt, nor is a request retried once other
+        # failures have opened the circuit
+        if probe or self.circuit_breaker.state == CircuitBreaker.OPEN:
+            return False
+        return self.retry_policy.should_retry(method, attempt, resp, error)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = endpoint_name(method, url)
+        probe = self._acquire_circuit(endpoint)
+        attempt = 0
+        waited = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            resp = None
+            error = None
+            started = time.time()
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                error = ex
+            self.metrics.record(
+                endpoint,
+                time.time() - started,
+                resp.status_code if resp is not None else None,
+                len(resp.content) if resp is not None else 0
+            )
+
+            if self._should_retry(method, attempt, resp, error, probe):
+                delay = self.retry_policy.delay(attempt, resp)
+                if delay is not None and \
+                        waited + delay <= self.retry_policy.budget:
+                    self.metrics.record_retry(endpoint)
+                    time.sleep(delay)
+                    waited = waited + delay
+                    attempt = attempt + 1
+                    continue
+
+            self.circuit_breaker.record(
+                error is None and resp.status_code < 500, probe
+            )
+            if error is not None:
+                raise error
+            return resp
+
+    def close(self):
+        self.session.close()
 
     def create_url(self, path):
         return urljoin(self.api_root, path)
 
     def oauth_token(self):
-        resp = requests.post(self.create_url("/oauth/token"), data=dict(
-            client_id=self.client_id,
-            client_secret=self.client_secret,
-            grant_type="client_credentials"
-        ))
+        resp = self.request(
+            'POST',
+            self.create_url("/oauth/token"),
+            data=dict(
+                client_id=self.client_id,
+                client_secret=self.client_secret,
+                grant_type="client_credentials"
+            )
+        )
 
-        self.token = resp.json().get('access_token')
-        self.expires_in = resp.json().get('expires_in')
+        # A rejected request must not leave the client without a token,
+        # every later request would ask again
+        if not 200 <= resp.status_code < 300:
+            raise ApiError(resp)
+        body = self.decode(resp)
+        if not body.get('access_token'):
+            raise ApiError(resp)
+        self.token = body['access_token']
+        self.expires_in = body.get('expires_in')
+        self.credentials.token_fetched(self.expires_in)
 
         return resp.status_code
 
     def api_root_response(self):
-        resp = requests.get(
+        resp = self.request(
+            'GET',
             self.create_url("/api/"), headers=DEFAULT_CLIENT_HEADERS
         )
-        self.api_root_resp = resp.json().get('links')
+        self.api_root_resp = self.decode(resp).get('links')
+        self.credentials.api_root_fetched()
 
         return resp.status_code
 
     def _fetch_token_if_not(self):
-        if self.token is None:
-            return self.oauth_token()
+        return self.credentials.ensure_token()
 
     def _fetch_api_root_if_not(self):
-        if self.api_root_resp is None:
-            return self.api_root_response()
+        return self.credentials.ensure_api_root()
 
     def token_header(self):
         headers = {'Authorization': 'Bearer ' + self.token}
@@ -208,6 +959,12 @@ class Client(object):
             headers['x-admin-mode'] = 'admin'
         return headers
 
+    def request_headers(self, extra=None):
+        headers = dict(self.token_header(), **DEFAULT_CLIENT_HEADERS)
+        if extra:
+            headers.update(extra)
+        return headers
+
     def resource_url(self, resource_type, id):
         resource_path = self.api_root_resp[resource_type]['self']
         if id:
@@ -215,14 +972,86 @@ class Client(object):
 
         return resource_path
 
-    def get(self, resource_type, id=None):
+    def _send(self, method, url, headers=None, **kwargs):
+        if method != 'GET' and self.cache is not None:
+            # Writes are rare, drop everything rather than guess what changed
+            self.cache.clear()
         self._fetch_token_if_not()
-        self._fetch_api_root_if_not()
-        return self.handle_resp(
-            requests.get(
-                self.create_url(self.resource_url(resource_type, id)),
-                headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS)
+        resp = self.request(
+            method,
+            self.create_url(url),
+            headers=self.request_headers(headers),
+            **kwargs
+        )
+        if resp.status_code == 401:
+            # Token revoked or expired early, renew it and retry once
+            self.credentials.invalidate_token()
+            self._fetch_token_if_not()
+            resp = self.request(
+                method,
+                self.create_url(url),
+                headers=self.request_headers(headers),
+                **kwargs
             )
+        return resp
+
+    def _get_model(self, url, params):
+        # Callers asking for a url already being fetched share its result
+        if not self.coalesce:
+            return self._reuse(self._cached_get(url, params))
+        key = request_key(self.create_url(url), params)
+        with self.inflight_lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = InFlight()
+        if not leader:
+            self.metrics.record_coalesced(endpoint_name('GET', key[0]))
+            return self._reuse(flight.wait())
+        try:
+            flight.result = self._cached_get(url, params)
+            return self._reuse(flight.result)
+        except Exception as ex:
+            flight.error = ex
+            raise
+        finally:
+            with self.inflight_lock:
+                del self.inflight[key]
+            flight.done.set()
+
+    def _cached_get(self, url, params):
+        # Returns the model shared with the cache and other callers, only
+        # _get_model hands it out, through _reuse
+        if self.cache is None:
+            return self.handle_resp(self._send('GET', url, params=params))
+        key = request_key(self.create_url(url), params)
+        entry = self.cache.get(key)
+        if entry is not None and self.cache.fresh(entry):
+            self.cache.hits += 1
+            return entry.model
+        resp = self._send('GET', url, params=params,
+                          headers=entry.validators() if entry else None)
+        if resp.status_code == 304 and entry is not None:
+            self.cache.revalidated += 1
+            return entry.model
+        self.cache.misses += 1
+        model = self.handle_resp(resp)
+        self.cache.store(key, resp, model)
+        return model
+
+    def _reuse(self, model):
+        # Collections grow in place as pages load, hand out a copy
+        if isinstance(model, ResourceCollection):
+            return self.collection_class(self, dict(model.meta), model.type_,
+                                         list(model.resources))
+        return model
+
+    def get(self, resource_type, id=None, include=None, fields=None,
+            **params):
+        self._fetch_api_root_if_not()
+        return self._get_model(
+            self.resource_url(resource_type, id),
+            jsonapi_params(include, fields, **params)
         )
 
     def to_relationship_dict(self, relationships):
@@ -230,7 +1059,6 @@ class Client(object):
                 for k, r in relationships.items()}
 
     def update(self, resource_type, id, attributes, relationships):
-        self._fetch_token_if_not()
         self._fetch_api_root_if_not()
         rels = self.to_relationship_dict(relationships)
         req_body = {'data': {
@@ -241,23 +1069,16 @@ class Client(object):
         }}
 
         return self.handle_resp(
-            requests.patch(
-                self.create_url(self.resource_url(resource_type, id)),
-                headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS),
-                json=req_body
+            self._send(
+                'PATCH', self.resource_url(resource_type, id), json=req_body
             )
         )
 
     def delete(self, resource_type, id):
-        self._fetch_token_if_not()
         self._fetch_api_root_if_not()
-        requests.delete(
-            self.create_url(self.resource_url(resource_type, id)),
-            headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS)
-        )
+        self._send('DELETE', self.resource_url(resource_type, id))
 
     def create(self, resource_type, attributes={}, relationships={}, params={}):
-        self._fetch_token_if_not()
         self._fetch_api_root_if_not()
         rels = self.to_relationship_dict(relationships)
         req_body = {'data': {
@@ -267,82 +1088,101 @@ class Client(object):
         }}
 
         return self.handle_resp(
-            requests.post(
-                self.create_url(self.resource_url(resource_type, None)),
-                headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS),
+            self._send(
+                'POST',
+                self.resource_url(resource_type, None),
                 json=req_body,
                 params=params
             )
         )
 
     def delete_url(self, url, data):
-        return self.handle_resp(requests.delete(
-            self.create_url(url),
-            headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS),
-            json=data
-        ))
+        return self.handle_resp(self._send('DELETE', url, json=data))
 
     def patch_url(self, url, data):
-        return self.handle_resp(requests.patch(
-            self.create_url(url),
-            headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS),
-            json=data
-        ))
+        return self.handle_resp(self._send('PATCH', url, json=data))
 
     def post_url(self, url, data):
-        return self.handle_resp(requests.post(
-            self.create_url(url),
-            headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS),
-            json=data
-        ))
+        return self.handle_resp(self._send('POST', url, json=data))
 
-    def get_url(self, url, **params):
-        return self.handle_resp(requests.get(
-            self.create_url(url),
-            params=params,
-            headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS)
-        ))
+    def get_url(self, url, include=None, fields=None, **params):
+        return self._get_model(url, jsonapi_params(include, fields, **params))
 
     def create_model(self,
                      id=None,
                      type=None,
                      attributes={},
-                     relationships={}):
+                     relationships={},
+                     included=None,
+                     **kwargs):
         klass = self.mapper.get(type, self.default_model)
-        return klass(self, id, type, attributes, relationships)
+        model = klass(self, id, type, attributes, relationships)
+        if included:
+            model.resolve_included(included)
+        return model
+
+    def model_from(self, data, included=None):
+        """Model straight from a decoded JSON:API resource object."""
+        type_ = data.get('type')
+        model = self.mapper.get(type_, self.default_model)(
+            self, data.get('id'), type_, data.get('attributes') or {},
+            data.get('relationships') or {}
+        )
+        if included:
+            model.resolve_included(included)
+        return model
+
+    def index_included(self, included):
+        """Builds {(type, id): model} from a top-level included array."""
+        index = {}
+        for r in included:
+            model = self.model_from(r)
+            index[(model.type_, model.id_)] = model
+        for model in index.values():
+            model.resolve_included(index)
+        return index
+
+    def decode(self, resp):
+        # The raw bytes go to the decoder once, no intermediate str
+        return self.json_loads(resp.content)
 
     def handle_resp(self, resp):
         if not resp.status_code == 204 and resp.status_code < 400:
-            body = resp.json()
+            body = self.decode(resp)
         else:
             body = ''
 
+        included = self.index_included(body.get('included', [])) \
+            if body else None
+
         if resp.status_code == 200 and isinstance(body['data'], list) and \
            body['data']:
-            return ResourceCollection(
+            return self.collection_class(
                 self,
                 body['meta'],
                 body['data'][0]['type'],
-                [self.create_model(**r) for r in body['data']]
+                [self.model_from(r, included) for r in body['data']]
             )
         elif (resp.status_code == 200 or resp.status_code == 201) and \
              not body['data']:
             raise EmptyBodyException(resp)
         elif resp.status_code == 200 or resp.status_code == 201:
-            return self.create_model(**body['data'])
+            return self.model_from(body['data'], included)
         elif resp.status_code >= 400:
             raise ApiError(resp)
         else:
             return body
 
 
-def make_client(client_id, client_secret, root, mapper={}, admin=False):
+def make_client(client_id, client_secret, root, mapper={}, admin=False,
+                **kwargs):
     c = Client(
        client_id=client_id,
        client_secret=client_secret,
        api_root=root,
        mapper=mapper,
-       admin=admin
+       admin=admin,
+       **kwargs
     )
     c.oauth_token()
     c.api_root_response()
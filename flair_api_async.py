@@ -0,0 +1,436 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from flair_api import ApiError
+from flair_api import Client
+from flair_api import CredentialManager
+from flair_api import Relationship
+from flair_api import Resource
+from flair_api import ResourceCollection
+from flair_api import EmptyBodyException
+from flair_api import DEFAULT_CLIENT_HEADERS
+from flair_api import endpoint_name
+from flair_api import jsonapi_params
+from flair_api import request_key
+from flair_api import relationship_data
+
+
+class AsyncResponse(object):
+    """Fully read response exposing what Client.handle_resp expects."""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf8')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncRelationship(Relationship):
+    __slots__ = ()
+
+    async def get(self, **params):
+        if self.resolved is not None and not params:
+            return self.resolved
+        return await self.client.get_url(self.related_href, **params)
+
+    async def add(self, data):
+        data = data if isinstance(data, list) else [data]
+        rel_form = relationship_data(data)
+        self.data.append(rel_form)
+        await self.client.post_url(self.self_href, dict(data=rel_form))
+
+    async def update(self, data):
+        rel_form = relationship_data(data)
+        self.data = rel_form
+        await self.client.patch_url(self.self_href, dict(data=rel_form))
+        return self.data
+
+    async def delete(self, data):
+        data = data if isinstance(data, list) else [data]
+        rel_form = relationship_data(data)
+        self.data.remove(rel_form)
+        await self.client.delete_url(self.self_href, dict(data=rel_form))
+
+
+class AsyncResourceCollection(ResourceCollection):
+    async def load_next_page(self):
+        if self.meta.get('next'):
+            col = await self.client.get_url(self.meta['next'])
+            self.resources.extend(col.resources)
+            self.meta = col.meta
+
+    async def load_all(self):
+        while self.meta.get('next'):
+            await self.load_next_page()
+        return self
+
+    async def all(self):
+        idx = 0
+        while True:
+            while idx < len(self.resources):
+                yield self.resources[idx]
+                idx = idx + 1
+            if not self.meta.get('next'):
+                return
+            await self.load_next_page()
+
+    async def pages(self, prefetch=False):
+        page = self
+        while page is not None:
+            next_url = page.meta.get('next')
+            fetch = asyncio.ensure_future(self.client.get_url(next_url)) \
+                if next_url and prefetch else None
+            yield page
+            if not next_url:
+                return
+            try:
+                page = await fetch if fetch is not None \
+                    else await self.client.get_url(next_url)
+            except EmptyBodyException:
+                return
+
+    async def stream(self, prefetch=False):
+        async for page in self.pages(prefetch):
+            for r in page.resources:
+                yield r
+
+    def __aiter__(self):
+        return self.stream()
+
+    async def up_to(self, limit):
+        while len(self.resources) < limit and self.meta.get('next'):
+            await self.load_next_page()
+        return self
+
+
+class AsyncResource(Resource):
+    __slots__ = ()
+    relationship_class = AsyncRelationship
+
+    async def get_self(self, **params):
+        resp = await self.client.get(self.type_, id=self.id_, **params)
+        self.attributes = resp.attributes
+        self.relationships = resp.relationships
+        return self
+
+    async def get_rel(self, rel, **params):
+        return await self.relationships[rel].get(**params)
+
+    async def update(self, attributes={}, relationships={}):
+        resp = await self.client.update(
+            self.type_, self.id_, attributes, relationships
+        )
+        self.attributes = resp.attributes
+        self.relationships = resp.relationships
+        return self
+
+    async def delete(self):
+        await self.client.delete(self.type_, self.id_)
+        self.deleted = True
+
+    async def add_rel(self, **kwargs):
+        for rel, val in kwargs.items():
+            await self.relationships[rel].add(val)
+
+    async def update_rel(self, **kwargs):
+        for rel, val in kwargs.items():
+            await self.relationships[rel].update(val)
+
+    async def delete_rel(self, **kwargs):
+        for rel, val in kwargs.items():
+            await self.relationships[rel].delete(val)
+
+
+class AsyncCredentialManager(CredentialManager):
+    """CredentialManager whose renewals are awaited on the client's loop.
+
+    The lock is an asyncio.Lock created on first use, so concurrent
+    requests of the loop wait for a single token or /api/ fetch.
+    """
+
+    def __init__(self, client, **kwargs):
+        super(AsyncCredentialManager, self).__init__(client, **kwargs)
+        self.lock = None
+
+    def _lock(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        return self.lock
+
+    def invalidate_token(self):
+        # Runs on the loop without awaiting, nothing can interleave
+        self.client.token = None
+
+    async def ensure_token(self):
+        async with self._lock():
+            if self.token_expired():
+                return await self.client.oauth_token()
+
+    async def ensure_api_root(self):
+        async with self._lock():
+            if self.api_root_expired():
+                return await self.client.api_root_response()
+
+
+class AsyncClient(Client):
+    """Client with the same surface running on one asyncio event loop.
+
+    The aiohttp session is created on first use so the client can be
+    built outside of the loop. Call close() when done.
+    """
+    collection_class = AsyncResourceCollection
+    credentials_class = AsyncCredentialManager
+
+    def __init__(self, default_model=AsyncResource, **kwargs):
+        super(AsyncClient, self).__init__(default_model=default_model,
+                                          **kwargs)
+
+    def make_session(self, pool_size, keep_alive):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        return None
+
+    def _session(self):
+        if self.session is None:
+            connect, read = self.timeout
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size,
+                    force_close=not self.keep_alive
+                ),
+                timeout=aiohttp.ClientTimeout(connect=connect, sock_read=read)
+            )
+        return self.session
+
+    async def request(self, method, url, **kwargs):
+        endpoint = endpoint_name(method, url)
+        probe = self._acquire_circuit(endpoint)
+        attempt = 0
+        waited = 0
+        while True:
+            if self.rate_limiter is not None:
+                wait = self.rate_limiter.reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            resp = None
+            error = None
+            started = time.time()
+            try:
+                async with self._session().request(method, url,
+                                                   **kwargs) as r:
+                    resp = AsyncResponse(r.status, r.headers, await r.read())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as ex:
+                error = ex
+            self.metrics.record(
+                endpoint,
+                time.time() - started,
+                resp.status_code if resp is not None else None,
+                len(resp.content) if resp is not None else 0
+            )
+
+            if self._should_retry(method, attempt, resp, error, probe):
+                delay = self.retry_policy.delay(attempt, resp)
+                if delay is not None and \
+                        waited + delay <= self.retry_policy.budget:
+                    self.metrics.record_retry(endpoint)
+                    await asyncio.sleep(delay)
+                    waited = waited + delay
+                    attempt = attempt + 1
+                    continue
+
+            self.circuit_breaker.record(
+                error is None and resp.status_code < 500, probe
+            )
+            if error is not None:
+                raise error
+            return resp
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def oauth_token(self):
+        resp = await self.request(
+            'POST',
+            self.create_url("/oauth/token"),
+            data=dict(
+                client_id=self.client_id,
+                client_secret=self.client_secret,
+                grant_type="client_credentials"
+            )
+        )
+
+        # A rejected request must not leave the client without a token,
+        # every later request would ask again
+        if not 200 <= resp.status_code < 300:
+            raise ApiError(resp)
+        body = self.decode(resp)
+        if not body.get('access_token'):
+            raise ApiError(resp)
+        self.token = body['access_token']
+        self.expires_in = body.get('expires_in')
+        self.credentials.token_fetched(self.expires_in)
+
+        return resp.status_code
+
+    async def api_root_response(self):
+        resp = await self.request(
+            'GET',
+            self.create_url("/api/"), headers=DEFAULT_CLIENT_HEADERS
+        )
+        self.api_root_resp = self.decode(resp).get('links')
+        self.credentials.api_root_fetched()
+
+        return resp.status_code
+
+    async def _fetch_token_if_not(self):
+        return await self.credentials.ensure_token()
+
+    async def _fetch_api_root_if_not(self):
+        return await self.credentials.ensure_api_root()
+
+    async def _send(self, method, url, headers=None, **kwargs):
+        if method != 'GET' and self.cache is not None:
+            self.cache.clear()
+        await self._fetch_token_if_not()
+        resp = await self.request(
+            method,
+            self.create_url(url),
+            headers=self.request_headers(headers),
+            **kwargs
+        )
+        if resp.status_code == 401:
+            # Token revoked or expired early, renew it and retry once
+            self.credentials.invalidate_token()
+            await self._fetch_token_if_not()
+            resp = await self.request(
+                method,
+                self.create_url(url),
+                headers=self.request_headers(headers),
+                **kwargs
+            )
+        return resp
+
+    async def _get_model(self, url, params):
+        if not self.coalesce:
+            return self._reuse(await self._cached_get(url, params))
+        key = request_key(self.create_url(url), params)
+        flight = self.inflight.get(key)
+        if flight is not None:
+            self.metrics.record_coalesced(endpoint_name('GET', key[0]))
+            # shield, one caller being cancelled must not cancel the others
+            return self._reuse(await asyncio.shield(flight))
+        flight = asyncio.ensure_future(self._cached_get(url, params))
+
+        def forget(done):
+            if self.inflight.get(key) is done:
+                del self.inflight[key]
+        flight.add_done_callback(forget)
+        self.inflight[key] = flight
+        return self._reuse(await asyncio.shield(flight))
+
+    async def _cached_get(self, url, params):
+        if self.cache is None:
+            return self.handle_resp(
+                await self._send('GET', url, params=params)
+            )
+        key = request_key(self.create_url(url), params)
+        entry = self.cache.get(key)
+        if entry is not None and self.cache.fresh(entry):
+            self.cache.hits += 1
+            return entry.model
+        resp = await self._send('GET', url, params=params,
+                                headers=entry.validators() if entry else None)
+        if resp.status_code == 304 and entry is not None:
+            self.cache.revalidated += 1
+            return entry.model
+        self.cache.misses += 1
+        model = self.handle_resp(resp)
+        self.cache.store(key, resp, model)
+        return model
+
+    async def get(self, resource_type, id=None, include=None, fields=None,
+                  **params):
+        await self._fetch_api_root_if_not()
+        return await self._get_model(
+            self.resource_url(resource_type, id),
+            jsonapi_params(include, fields, **params)
+        )
+
+    async def update(self, resource_type, id, attributes, relationships):
+        await self._fetch_api_root_if_not()
+        rels = self.to_relationship_dict(relationships)
+        req_body = {'data': {
+            'id': id,
+            'type': resource_type,
+            'attributes': attributes,
+            'relationships': rels
+        }}
+
+        return self.handle_resp(
+            await self._send(
+                'PATCH', self.resource_url(resource_type, id), json=req_body
+            )
+        )
+
+    async def delete(self, resource_type, id):
+        await self._fetch_api_root_if_not()
+        await self._send('DELETE', self.resource_url(resource_type, id))
+
+    async def create(self, resource_type, attributes={}, relationships={},
+                     params={}):
+        await self._fetch_api_root_if_not()
+        rels = self.to_relationship_dict(relationships)
+        req_body = {'data': {
+            'type': resource_type,
+            'attributes': attributes,
+            'relationships': rels
+        }}
+
+        return self.handle_resp(
+            await self._send(
+                'POST',
+                self.resource_url(resource_type, None),
+                json=req_body,
+                params=params
+            )
+        )
+
+    async def delete_url(self, url, data):
+        return self.handle_resp(await self._send('DELETE', url, json=data))
+
+    async def patch_url(self, url, data):
+        return self.handle_resp(await self._send('PATCH', url, json=data))
+
+    async def post_url(self, url, data):
+        return self.handle_resp(await self._send('POST', url, json=data))
+
+    async def get_url(self, url, include=None, fields=None, **params):
+        return await self._get_model(
+            url, jsonapi_params(include, fields, **params)
+        )
+
+
+async def make_async_client(client_id, client_secret, root, mapper={},
+                            admin=False, **kwargs):
+    c = AsyncClient(
+       client_id=client_id,
+       client_secret=client_secret,
+       api_root=root,
+       mapper=mapper,
+       admin=admin,
+       **kwargs
+    )
+    await c.oauth_token()
+    await c.api_root_response()
+    return c
@@ -0,0 +1,103 @@
+import polyinterface
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Thread
+
+LOGGER = polyinterface.LOGGER
+
+
+class PendingWrite(object):
+    def __init__(self, resource, due):
+        self.resource = resource
+        self.attributes = {}
+        self.callbacks = []
+        self.due = due
+
+
+class CommandQueue(object):
+    """Coalesces attribute writes and PATCHes them off the caller thread.
+
+    Writes to the same resource within window seconds of the first one are
+    merged, the last value of each attribute wins. Each resource has at most
+    one PATCH in flight, different resources are written concurrently.
+    Callbacks are called with (resource, error) once the PATCH completes.
+    stop() sends what is still pending, waiting up to timeout seconds for
+    the writes queued behind a PATCH in flight.
+    """
+
+    def __init__(self, window=0.5, workers=4):
+        self.window = window
+        self.pending = OrderedDict()
+        self.inflight = set()
+        self.cond = Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.running = True
+        self.deadline = None
+        self.thread = Thread(target=self._run, name='FlairCommands')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, resource, attributes, callback=None):
+        key = (resource.type_, resource.id_)
+        with self.cond:
+            entry = self.pending.get(key)
+            if entry is None:
+                entry = PendingWrite(resource, time.time() + self.window)
+                self.pending[key] = entry
+            entry.resource = resource
+            entry.attributes.update(attributes)
+            if callback is not None and callback not in entry.callbacks:
+                entry.callbacks.append(callback)
+            self.cond.notify()
+
+    def stop(self, timeout=10):
+        with self.cond:
+            self.running = False
+            self.deadline = time.time() + timeout
+            self.cond.notify()
+        self.thread.join()
+        # The PATCHes already sent finish before the session is closed
+        self.executor.shutdown(wait=True)
+
+    def _run(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                wait = None
+                for key in list(self.pending):
+                    if key in self.inflight:
+                        continue
+                    entry = self.pending[key]
+                    if entry.due <= now or not self.running:
+                        del self.pending[key]
+                        self.inflight.add(key)
+                        self.executor.submit(self._write, key, entry)
+                    elif wait is None or entry.due - now < wait:
+                        wait = entry.due - now
+                if not self.running:
+                    # Writes to a resource with a PATCH in flight go out
+                    # once it completes
+                    if not self.pending and not self.inflight:
+                        break
+                    if now >= self.deadline:
+                        LOGGER.warning('Dropping %d pending commands, the Flair API did not answer in time', len(self.pending))
+                        break
+                    wait = self.deadline - now
+                self.cond.wait(wait)
+
+    def _write(self, key, entry):
+        error = None
+        try:
+            entry.resource.update(attributes=entry.attributes)
+        except Exception as ex:
+            error = ex
+        finally:
+            with self.cond:
+                self.inflight.discard(key)
+                self.cond.notify()
+        for callback in entry.callbacks:
+            try:
+                callback(entry.resource, error)
+            except Exception as ex:
+                LOGGER.error('Error command callback: %s', str(ex))
@@ -0,0 +1,114 @@
+import time
+from array import array
+from threading import Lock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NAN = float('nan')
+DEFAULT_HISTORY_SIZE = 60
+
+
+class ReadingHistory(object):
+    """Fixed size ring buffer of timestamped readings.
+
+    Every field is a preallocated array('d') of size slots, a missing
+    reading is stored as NaN, so memory per device stays the same however
+    long the node server runs. A sample less than min_interval seconds
+    after the newest one is dropped.
+    """
+
+    def __init__(self, fields, size=DEFAULT_HISTORY_SIZE, min_interval=0):
+        self.fields = tuple(fields)
+        self.size = max(2, size)
+        self.min_interval = min_interval
+        self.times = array('d', [0.0]) * self.size
+        self.values = {f: array('d', [NAN]) * self.size for f in self.fields}
+        self.count = 0
+        self.newest = -1
+        self.lock = Lock()
+
+    def add(self, sample, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.count and now - self.times[self.newest] < self.min_interval:
+                return
+            self.newest = (self.newest + 1) % self.size
+            self.count = min(self.size, self.count + 1)
+            self.times[self.newest] = now
+            for field in self.fields:
+                try:
+                    value = float(sample.get(field))
+                except (TypeError, ValueError):
+                    value = NAN
+                self.values[field][self.newest] = value
+
+    def stats(self):
+        """Returns {field: {'min', 'max', 'slope'}} over the buffer.
+
+        slope is the least squares change per second, None until two
+        readings some time apart are in. Fields without readings are left
+        out. Slot order does not matter to any of these so the ring is used
+        as is.
+        """
+        with self.lock:
+            if numpy is not None:
+                return self._stats_numpy()
+            return self._stats_python()
+
+    def _stats_numpy(self):
+        n = self.count
+        # Centered on the newest sample, epoch seconds squared lose precision
+        times = numpy.frombuffer(self.times, dtype=numpy.float64)[:n] - \
+            self.times[self.newest]
+        stats = {}
+        for field in self.fields:
+            values = numpy.frombuffer(self.values[field],
+                                      dtype=numpy.float64)[:n]
+            known = ~numpy.isnan(values)
+            k = int(known.sum())
+            if k == 0:
+                continue
+            t = times[known]
+            v = values[known]
+            slope = None
+            if k >= 2:
+                tc = t - t.mean()
+                denom = float(numpy.dot(tc, tc))
+                if denom > 0:
+                    slope = float(numpy.dot(tc, v - v.mean())) / denom
+            stats[field] = {'min': float(v.min()), 'max': float(v.max()),
+                            'slope': slope}
+        return stats
+
+    def _stats_python(self):
+        n = self.count
+        origin = self.times[self.newest]
+        stats = {}
+        for field in self.fields:
+            values = self.values[field]
+            k = 0
+            st = sv = stt = stv = 0.0
+            low = high = None
+            for i in range(n):
+                v = values[i]
+                if v != v:
+                    continue
+                t = self.times[i] - origin
+                k = k + 1
+                st = st + t
+                sv = sv + v
+                stt = stt + t * t
+                stv = stv + t * v
+                low = v if low is None or v < low else low
+                high = v if high is None or v > high else high
+            if k == 0:
+                continue
+            slope = None
+            denom = k * stt - st * st
+            if k >= 2 and denom > 0:
+                slope = (k * stv - st * sv) / denom
+            stats[field] = {'min': low, 'max': high, 'slope': slope}
+        return stats
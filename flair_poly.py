@@ -7,17 +7,49 @@ Using the Flair API Client - https://github.com/flair-systems/flair-api-client-p
 """
 
 import polyinterface
-import hashlib
 import time
 import json
+import os
 import sys
 from copy import deepcopy
-from threading import Thread
-from flair_api import make_client
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor, wait
+from flair_api import Client
 from flair_api import ApiError
 from flair_api import EmptyBodyException
+from flair_api import RetryPolicy
+from flair_api import CircuitBreaker
+from flair_api import CircuitOpenError
+from flair_api import restricted_model
+from flair_scheduler import RefreshScheduler
+from flair_scheduler import AdaptivePollScheduler
+from flair_commands import CommandQueue
+from flair_addressing import AddressBook
+from flair_addressing import legacy_address
+from flair_history import ReadingHistory
+from flair_scope import TopologyScope
 
 LOGGER = polyinterface.LOGGER
+# Collections fetched once per poll in bulk mode
+BULK_TYPES = ['structures', 'rooms', 'pucks', 'vents']
+# Related resources loaded in the same response as their parent
+INCLUDES = {'pucks': ['current-reading'], 'vents': ['current-reading']}
+# Sparse fieldsets, only what the nodes read
+FIELDS = {
+    'structures': ['name', 'is-active', 'set-point-temperature-c', 'home', 'set-point-mode', 'home-away-mode', 'mode', 'rooms'],
+    'rooms': ['name', 'active', 'current-temperature-c', 'current-humidity', 'set-point-c', 'pucks', 'vents', 'structure'],
+    'pucks': ['name', 'inactive', 'current-temperature-c', 'current-humidity', 'current-reading', 'room'],
+    'vents': ['name', 'inactive', 'percent-open', 'voltage', 'current-reading', 'room'],
+    'sensor-readings': ['rssi', 'system-voltage'],
+    'vent-readings': ['duct-pressure', 'duct-temperature-c', 'rssi']
+}
+DISCOVERY_CACHE_VERSION = 1
+# Longest sleep of the adaptive poll thread, in seconds
+POLL_TICK = 5
+# Trend statistics derived from the history slope, per second to per unit
+TREND_SCALES = {'per_hour': 3600, 'per_day': 86400}
+# Controller GV18 index of each circuit breaker state
+CONNECTIVITY = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
 SERVERDATA = json.load(open('server.json'))
 VERSION = SERVERDATA['credits'][0]['version']
 
@@ -32,6 +64,21 @@ def get_profile_info(logger):
     f.close()
     return { 'version': pv }
 
+def param_bool(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def resource_key(resource):
+    return (resource.type_, resource.id_)
+
+def resource_to_cache(resource):
+    # JSON-able form create_model() accepts, trimmed to what the nodes use
+    fields = FIELDS.get(resource.type_)
+    return {'id': resource.id_,
+            'type': resource.type_,
+            'attributes': {k: v for k, v in resource.attributes.items() if fields is None or k in fields},
+            'relationships': {rel: {'links': {'self': r.self_href, 'related': r.related_href}, 'data': r.data}
+                              for rel, r in resource.relationships.items() if fields is None or rel in fields}}
+
 class Controller(polyinterface.Controller):
 
     def __init__(self, polyglot):
@@ -40,9 +87,57 @@ class Controller(polyinterface.Controller):
         self.queryON = False
         self.client_id = ""
         self.client_secret = ""
+        self.api_root = 'https://api.flair.co/'
         self.api_client = None
         self.discovery_thread = None
         self.hb = 0
+        self.pool_size = 10
+        self.connect_timeout = 5
+        self.read_timeout = 30
+        self.discovery_workers = 4
+        self.max_retries = 3
+        self.requests_per_minute = 0
+        self.breaker_threshold = 5
+        self.breaker_reset = 30
+        self.breaker_max_reset = 300
+        self.lastConnectivity = CircuitBreaker.CLOSED
+        self.startedAt = time.time()
+        self.response_cache = 256
+        self.cache_ttl = 5
+        self.poll_mode = 'bulk'
+        self.use_include = True
+        self.sparse_fields = True
+        self.refresh_scheduler = RefreshScheduler()
+        self.poll_scheduler = AdaptivePollScheduler()
+        self.poll_thread = None
+        self.pollStop = Event()
+        # Minimum change worth reporting to the ISY, keyed by driver uom
+        self.deadbands = {4: 0.2, 17: 0.36, 51: 1, 72: 0.05, 56: 2, 58: 60}
+        self.resync_interval = 3600
+        self.lastResync = time.time()
+        self.update_workers = 4
+        self.node_timeout = 60
+        self.update_executor = None
+        self.update_lock = Lock()
+        self.updating = {}
+        self.command_window = 0.5
+        self.command_workers = 4
+        self.command_queue = None
+        self.discovery_cache = True
+        self.remove_vanished = False
+        self.scope = TopologyScope()
+        self.address_book = AddressBook()
+        self.nodesByResource = {}
+        # Room resource key to the resource keys of its vents and pucks
+        self.roomDevices = {}
+        self.nodeTimings = {}
+        self.lastPollSeconds = 0.0
+        self.metrics_log = True
+        self.metrics_file = ''
+        self.history_size = 60
+        self.voltage_interval = 900
+        self.restored = False
+        self.customData = None
 
     def start(self):
         LOGGER.info('Started Flair for v2 NodeServer version %s', str(VERSION))
@@ -54,26 +149,105 @@ class Controller(polyinterface.Controller):
             if 'client_secret' in self.polyConfig['customParams']:
                 self.client_secret = self.polyConfig['customParams']['client_secret']
 
+            self.api_root = self.getParam('api_root', self.api_root)
+            self.pool_size = self.getParam('pool_size', self.pool_size, int)
+            self.connect_timeout = self.getParam('connect_timeout', self.connect_timeout, float)
+            self.read_timeout = self.getParam('read_timeout', self.read_timeout, float)
+            self.discovery_workers = max(1, self.getParam('discovery_workers', self.discovery_workers, int))
+            self.max_retries = max(0, self.getParam('max_retries', self.max_retries, int))
+            self.requests_per_minute = max(0, self.getParam('requests_per_minute', self.requests_per_minute, int))
+            self.breaker_threshold = max(0, self.getParam('breaker_threshold', self.breaker_threshold, int))
+            self.breaker_reset = max(1, self.getParam('breaker_reset', self.breaker_reset, float))
+            self.breaker_max_reset = max(self.breaker_reset, self.getParam('breaker_max_reset', self.breaker_max_reset, float))
+            self.response_cache = max(0, self.getParam('response_cache', self.response_cache, int))
+            self.cache_ttl = max(0, self.getParam('cache_ttl', self.cache_ttl, float))
+            self.poll_mode = self.getParam('poll_mode', self.poll_mode).lower()
+            self.use_include = self.getParam('use_include', self.use_include, param_bool)
+            self.sparse_fields = self.getParam('sparse_fields', self.sparse_fields, param_bool)
+            self.poll_scheduler = AdaptivePollScheduler(self.getParam('poll_interval', self.poll_scheduler.interval, float),
+                                                        self.getParam('poll_min_interval', self.poll_scheduler.min_interval, float),
+                                                        self.getParam('poll_max_interval', self.poll_scheduler.max_interval, float),
+                                                        self.getParam('poll_boost', self.poll_scheduler.boost_seconds, float),
+                                                        max(0, self.getParam('poll_budget', self.poll_scheduler.budget, int)))
+            for type_ in self.refresh_scheduler.intervals:
+                self.refresh_scheduler.intervals[type_] = self.getParam('refresh_' + type_, self.refresh_scheduler.intervals[type_], int)
+            self.deadbands[4] = self.getParam('deadband_temp', self.deadbands[4], float)
+            self.deadbands[17] = round(self.deadbands[4] * 9/5, 2)
+            self.deadbands[51] = self.getParam('deadband_percent', self.deadbands[51], float)
+            self.deadbands[72] = self.getParam('deadband_volt', self.deadbands[72], float)
+            self.deadbands[56] = self.getParam('deadband_rssi', self.deadbands[56], float)
+            self.deadbands[58] = self.getParam('deadband_age', self.deadbands[58], float)
+            self.resync_interval = self.getParam('resync_interval', self.resync_interval, int)
+            self.update_workers = max(1, self.getParam('update_workers', self.update_workers, int))
+            self.node_timeout = self.getParam('node_timeout', self.node_timeout, float)
+            self.command_window = max(0, self.getParam('command_window', self.command_window, float))
+            self.command_workers = max(1, self.getParam('command_workers', self.command_workers, int))
+            self.command_queue = CommandQueue(self.command_window, self.command_workers)
+            self.discovery_cache = self.getParam('discovery_cache', self.discovery_cache, param_bool)
+            self.remove_vanished = self.getParam('remove_vanished', self.remove_vanished, param_bool)
+            self.scope = TopologyScope(self.getParam('allow_structures', ''), self.getParam('deny_structures', ''),
+                                       self.getParam('allow_rooms', ''), self.getParam('deny_rooms', ''))
+            if self.scope.restricted:
+                LOGGER.info('Scope: structures allow %s deny %s, rooms allow %s deny %s',
+                            sorted(self.scope.allow_structures), sorted(self.scope.deny_structures),
+                            sorted(self.scope.allow_rooms), sorted(self.scope.deny_rooms))
+            self.metrics_log = self.getParam('metrics_log', self.metrics_log, param_bool)
+            self.metrics_file = self.getParam('metrics_file', self.metrics_file)
+            self.history_size = max(2, self.getParam('history_size', self.history_size, int))
+            self.voltage_interval = max(0, self.getParam('voltage_interval', self.voltage_interval, float))
+
             if self.client_id == "" or self.client_secret == "" :
                 LOGGER.error('Flair requires \'client_id\' \'client_secret\' parameters to be specified in custom configuration.')
                 return False
             else:
                 self.check_profile()
                 self.heartbeat()
+                self.api_client = self._make_api_client()
+                self.address_book = AddressBook(self.polyConfig['customData'].get('addresses'))
+                if self.discovery_cache:
+                    self.restored = self._restore_discovery_cache()
                 self.discover()
+                if self.poll_mode == 'adaptive':
+                    self.poll_thread = Thread(target=self._poll_loop, name='FlairPoll')
+                    self.poll_thread.daemon = True
+                    self.poll_thread.start()
                 
         except Exception as ex:
             LOGGER.error('Error starting Flair NodeServer: %s', str(ex))
             
+    def getParam(self, name, default, cast=str):
+        try:
+            if name in self.polyConfig['customParams']:
+                return cast(self.polyConfig['customParams'][name])
+        except ValueError:
+            LOGGER.error('Invalid value for parameter %s, using default %s', name, str(default))
+        return default
+
+    def stop(self):
+        LOGGER.info('Stopping Flair NodeServer')
+        self.pollStop.set()
+        if self.command_queue is not None:
+            self.command_queue.stop()
+        if self.update_executor is not None:
+            self.update_executor.shutdown(wait=False)
+        if self.api_client is not None:
+            self.api_client.close()
+
     def shortPoll(self):
         try:
             if self.discovery_thread is not None:
-                if self.discovery_thread.is_alive():
+                if not self.discovery_thread.is_alive():
+                    self.discovery_thread = None
+                elif not self.restored:
                     LOGGER.debug('Skipping shortPoll() while discovery in progress...')
                     return
-                else:
-                    self.discovery_thread = None
-            self.update()
+            if self.poll_mode == 'adaptive':
+                # Nodes are polled by _poll_loop on their own schedule
+                self.setDriver('ST', 1)
+                self.resyncIfDue()
+            else:
+                self.update()
+            self.publishConnectivity()
         except Exception as ex:
             LOGGER.error('Error shortPoll: %s', str(ex))
             
@@ -87,9 +261,15 @@ class Controller(polyinterface.Controller):
                 else: 
                     self.discovery_thread = None	
                     
-            # Renew Token
-            self.api_client.oauth_token()
-            self.api_client.api_root_response()
+            # Renew Token only when close to expiry
+            if self.api_client is not None and self.connectivity() != CircuitBreaker.OPEN:
+                self.api_client.credentials.ensure_token()
+                self.api_client.credentials.ensure_api_root()
+
+            if self.metrics_log:
+                self.logMetrics()
+            if self.metrics_file:
+                self.writeMetricsFile()
         except Exception as ex:
             LOGGER.error('Error longPoll: %s', str(ex))
     
@@ -97,7 +277,7 @@ class Controller(polyinterface.Controller):
         self.profile_info = get_profile_info(LOGGER)
         # Set Default profile version if not Found
         cdata = deepcopy(self.polyConfig['customData'])
-        LOGGER.info('check_profile: profile_info={0} customData={1}'.format(self.profile_info,cdata))
+        LOGGER.info('check_profile: profile_info={0} customData={1}'.format(self.profile_info,{k: v for k, v in cdata.items() if k != 'discovery'}))
         if not 'profile_info' in cdata:
             cdata['profile_info'] = { 'version': 0 }
         if self.profile_info['version'] == cdata['profile_info']['version']:
@@ -106,8 +286,7 @@ class Controller(polyinterface.Controller):
             self.update_profile = True
             self.poly.installprofile()
         LOGGER.info('check_profile: update_profile={}'.format(self.update_profile))
-        cdata['profile_info'] = self.profile_info
-        self.saveCustomData(cdata)
+        self.saveCustomDataKey('profile_info', self.profile_info)
 
     def install_profile(self,command):
         LOGGER.info("install_profile:")
@@ -123,17 +302,316 @@ class Controller(polyinterface.Controller):
             self.hb = 0
             
     def query(self):
-        for node in self.nodes:
-            self.nodes[node].reportDrivers()
+        # Discovery may add or remove nodes meanwhile, work on a snapshot
+        for address, node in list(self.nodes.items()):
+            if address == self.address:
+                self.reportDrivers()
+            else:
+                node.resync()
+        self.lastResync = time.time()
             
     def update(self):
+        if not self.update_lock.acquire(False):
+            LOGGER.warning('Skipping update() while the previous poll is still running...')
+            return
         try :
+            if self.connectivity() == CircuitBreaker.OPEN:
+                LOGGER.debug('Skipping update() while the Flair API is unreachable...')
+                return
+            startTime = time.time()
             self.setDriver('ST', 1)
-            for node in self.nodes:
-                if self.nodes[node].queryON == True :
-                    self.nodes[node].update()
+            dueTypes = self.refresh_scheduler.due_types()
+            # Types that failed to load stay due and are retried next poll
+            if self.poll_mode == 'bulk':
+                refreshed = self._bulk_refresh(dueTypes)
+            else:
+                refreshed = self._node_refresh(dueTypes)
+            self.refresh_scheduler.mark(refreshed)
+            results = self._update_nodes()
+            self.lastPollSeconds = time.time() - startTime
+            self.resyncIfDue()
+            LOGGER.info('Poll finished in %.2fs: %d ok, %d errors, %d timeouts, %d skipped, %d offline',
+                        time.time() - startTime,
+                        sum(1 for r in results.values() if r == 'ok'),
+                        sum(1 for r in results.values() if r.startswith('error')),
+                        sum(1 for r in results.values() if r == 'timeout'),
+                        sum(1 for r in results.values() if r == 'skipped'),
+                        sum(1 for r in results.values() if r == 'offline'))
+        except CircuitOpenError as ex:
+            LOGGER.warning('Flair API unreachable, keeping last known values: %s', str(ex))
         except Exception as ex:
             LOGGER.error('Error update: %s', str(ex))
+        finally:
+            self.update_lock.release()
+
+    def resyncIfDue(self):
+        if self.resync_interval > 0 and time.time() - self.lastResync >= self.resync_interval:
+            self.query()
+
+    def connectivity(self):
+        if self.api_client is None:
+            return CircuitBreaker.CLOSED
+        return self.api_client.circuit_breaker.state
+
+    def publishConnectivity(self):
+        # Circuit breaker state on the controller and the age of the last
+        # fetched values on every node, both computed without a request
+        state = self.connectivity()
+        if state != self.lastConnectivity:
+            if state == CircuitBreaker.OPEN:
+                LOGGER.warning('Flair API unreachable, nodes keep their last known values')
+            elif state == CircuitBreaker.CLOSED:
+                LOGGER.info('Flair API reachable again, polling resumed')
+            self.lastConnectivity = state
+        self.setDriver('GV18', CONNECTIVITY[state])
+        now = time.time()
+        for node in list(self.nodes.values()):
+            if node.address != self.address:
+                node.setDriver('GV17', int(now - (node.fetched or self.startedAt)))
+
+    def _poll_loop(self):
+        # Adaptive mode, wakes for the next due node or every POLL_TICK
+        while not self.pollStop.is_set():
+            try:
+                self._adaptive_poll()
+            except Exception as ex:
+                LOGGER.error('Error _poll_loop: %s', str(ex))
+            nextDue = self.poll_scheduler.next_due()
+            delay = POLL_TICK if nextDue is None else min(POLL_TICK, max(0.5, nextDue - time.time()))
+            self.pollStop.wait(delay)
+
+    def _adaptive_poll(self):
+        # Fetches and updates only the nodes the scheduler says are due,
+        # then reschedules each from whether its drivers changed.
+        state = self.connectivity()
+        if state == CircuitBreaker.OPEN:
+            return
+        due = [address for address in self.poll_scheduler.due() if address in self.nodes]
+        if state == CircuitBreaker.HALF_OPEN:
+            # One node probes the API, the others come back next tick
+            due = due[:1]
+        if not due:
+            return
+        startTime = time.time()
+        for address in due:
+            self.nodes[address].changed = False
+        results = self._update_nodes(due, fetch=True)
+        now = time.time()
+        for address in due:
+            node = self.nodes.get(address)
+            if node is not None:
+                self.poll_scheduler.record(address, node.changed, node.inactive(), now,
+                                           failed=results.get(address) == 'offline')
+        self.lastPollSeconds = time.time() - startTime
+        LOGGER.debug('Adaptive poll: %d nodes in %.2fs, %d errors, %d offline', len(due), self.lastPollSeconds,
+                     sum(1 for r in results.values() if r not in ('ok', 'offline')),
+                     sum(1 for r in results.values() if r == 'offline'))
+
+    def boostPolling(self, node):
+        # Poll a node fast for a while after a command, a room set point
+        # also moves the vents and pucks of the room
+        self.poll_scheduler.boost(node.address)
+        if node.id == 'FLAIR_ROOM':
+            for key in list(self.roomDevices.get(resource_key(node.objRoom), ())):
+                other = self.nodeForResource(*key)
+                if other is not None:
+                    self.poll_scheduler.boost(other.address)
+
+    def _update_nodes(self, addresses=None, fetch=False):
+        # Runs node.update() on the worker pool, returns {address: result}.
+        # With fetch each node first re-pulls its resources. A node still
+        # busy from an earlier poll is skipped, a node running longer than
+        # node_timeout is reported and left to finish on its own.
+        if self.update_executor is None:
+            self.update_executor = ThreadPoolExecutor(max_workers=self.update_workers)
+        results = {}
+        futures = {}
+        for node in list(self.nodes) if addresses is None else addresses:
+            if node not in self.nodes or self.nodes[node].queryON != True:
+                continue
+            if node in self.updating:
+                results[node] = 'skipped'
+                continue
+            self.updating[node] = None
+            futures[self.update_executor.submit(self._update_node, node, fetch)] = node
+
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=1)
+            for future in done:
+                node = futures[future]
+                try:
+                    future.result()
+                    results[node] = 'ok'
+                except CircuitOpenError:
+                    results[node] = 'offline'
+                except Exception as ex:
+                    LOGGER.error('Error update %s: %s', node, str(ex))
+                    results[node] = 'error: ' + str(ex)
+            now = time.time()
+            for future in list(pending):
+                node = futures[future]
+                started = self.updating.get(node)
+                if started is not None and now - started > self.node_timeout:
+                    LOGGER.error('Timeout update %s after %.0fs', node, now - started)
+                    results[node] = 'timeout'
+                    pending.discard(future)
+        return results
+
+    def _update_node(self, node, fetch=False):
+        started = time.time()
+        self.updating[node] = started
+        try:
+            if fetch:
+                for resource in self.nodes[node].resources():
+                    resource.get_self(**self._fetch_params(resource.type_))
+                self.nodes[node].fetched = time.time()
+            self.nodes[node].update()
+        finally:
+            del self.updating[node]
+            self._record_node_timing(node, time.time() - started)
+
+    def _record_node_timing(self, node, seconds):
+        timing = self.nodeTimings.get(node)
+        if timing is None:
+            timing = self.nodeTimings[node] = {'count': 0, 'seconds': 0.0, 'max': 0.0, 'last': 0.0}
+        timing['count'] += 1
+        timing['seconds'] += seconds
+        timing['last'] = seconds
+        timing['max'] = max(timing['max'], seconds)
+
+    def metricsSnapshot(self):
+        return {'client': self.api_client.metrics.snapshot() if self.api_client is not None else None,
+                'cache': self.api_client.cache.stats() if self.api_client is not None and self.api_client.cache is not None else None,
+                'nodes': {node: dict(timing) for node, timing in self.nodeTimings.items()},
+                'poll_seconds': self.lastPollSeconds,
+                'circuit': self.connectivity()}
+
+    def logMetrics(self, command=None):
+        snapshot = self.metricsSnapshot()
+        if snapshot['client'] is not None:
+            totals = snapshot['client']['totals']
+            LOGGER.info('Metrics: %d requests, %d errors, %d retries, %d coalesced, %d rejected, %d bytes, %.2fs in requests, last poll %.2fs',
+                        totals['requests'], totals['errors'], totals['retries'], totals['coalesced'], totals['rejected'], totals['bytes'], totals['seconds'], snapshot['poll_seconds'])
+            LOGGER.info('Metrics: Flair API circuit %s, opened %d times', snapshot['circuit'], self.api_client.circuit_breaker.opened)
+            for name, stats in sorted(snapshot['client']['endpoints'].items()):
+                LOGGER.info('Metrics: %s %d requests, %d errors, %d retries, avg %.3fs',
+                            name, stats['requests'], stats['errors'], stats['retries'], stats['seconds'] / max(1, stats['requests']))
+        if snapshot['cache'] is not None:
+            LOGGER.info('Metrics: cache %d entries, %d hits, %d not modified, %d misses',
+                        snapshot['cache']['entries'], snapshot['cache']['hits'], snapshot['cache']['revalidated'], snapshot['cache']['misses'])
+        slowest = sorted(snapshot['nodes'].items(), key=lambda item: item[1]['max'], reverse=True)[:5]
+        for node, timing in slowest:
+            LOGGER.info('Metrics: node %s %d updates, avg %.3fs, max %.3fs',
+                        node, timing['count'], timing['seconds'] / max(1, timing['count']), timing['max'])
+
+    def writeMetricsFile(self):
+        lines = []
+        if self.api_client is not None:
+            lines.append(self.api_client.metrics.prometheus_text())
+            if self.api_client.cache is not None:
+                cache = self.api_client.cache.stats()
+                lines.append('# TYPE flair_api_cache_total counter\n')
+                for result in ('hits', 'revalidated', 'misses'):
+                    lines.append('flair_api_cache_total{result="%s"} %d\n' % (result, cache[result]))
+            lines.append('# TYPE flair_api_circuit_state gauge\n')
+            lines.append('flair_api_circuit_state %d\n' % CONNECTIVITY[self.connectivity()])
+        lines.append('# TYPE flair_node_update_seconds summary\n')
+        for node, timing in sorted(self.nodeTimings.items()):
+            lines.append('flair_node_update_seconds_sum{address="%s"} %f\n' % (node, timing['seconds']))
+            lines.append('flair_node_update_seconds_count{address="%s"} %d\n' % (node, timing['count']))
+        lines.append('# TYPE flair_poll_seconds gauge\n')
+        lines.append('flair_poll_seconds %f\n' % self.lastPollSeconds)
+        # Write then rename so a scraper never reads half a file
+        tmpFile = self.metrics_file + '.tmp'
+        with open(tmpFile, 'w') as f:
+            f.write(''.join(lines))
+        os.replace(tmpFile, self.metrics_file)
+    
+    def _bulk_refresh(self, dueTypes):
+        # One paginated collection fetch per due resource type, each node
+        # then picks its fresh Resource out of the index. Returns the types
+        # that loaded completely, what a failed listing got before the
+        # error is still applied.
+        fresh = {}
+        refreshed = set()
+        for type_ in BULK_TYPES:
+            if type_ not in dueTypes:
+                continue
+            try:
+                for resource in self._bulk_fetch(type_):
+                    fresh[resource_key(resource)] = resource
+                refreshed.add(type_)
+            except ApiError as ex:
+                LOGGER.error('Error _bulk_refresh %s: %s', type_, str(ex))
+        now = time.time()
+        for address, node in list(self.nodes.items()):
+            if address != self.address:
+                node.refresh(fresh)
+                if all(resource_key(r) in fresh for r in node.resources()):
+                    node.fetched = now
+        return refreshed
+
+    def _bulk_fetch(self, type_):
+        # Yields every resource of type_. With a scope each type is listed
+        # under the polled structures, /api/structures/:id/<type>, so the
+        # other homes of the account cost nothing. Discovery already left
+        # out the structures without any allowed room.
+        params = self._fetch_params(type_)
+        if not self.scope.restricted:
+            try:
+                for resource in self.api_client.get(type_, **params).stream(prefetch=True):
+                    yield resource
+            except EmptyBodyException:
+                pass
+            return
+        self.api_client.credentials.ensure_api_root()
+        for node in list(self.nodes.values()):
+            if node.id != 'FLAIR_STRUCT' or not node.queryON or not self.scope.structure_selected(node.objStructure):
+                continue
+            structureId = node.objStructure.id_
+            try:
+                if type_ == 'structures':
+                    yield self.api_client.get(type_, id=structureId, **params)
+                    continue
+                url = self.api_client.resource_url('structures', structureId) + '/' + type_
+                for resource in self.api_client.get_url(url, **params).stream(prefetch=True):
+                    yield resource
+            except EmptyBodyException:
+                pass
+
+    def _fetch_params(self, type_):
+        params = {}
+        if self.use_include and type_ in INCLUDES:
+            params['include'] = INCLUDES[type_]
+        if self.sparse_fields:
+            types = [type_]
+            if 'include' in params:
+                types = types + ['sensor-readings', 'vent-readings']
+            params['fields'] = {t: FIELDS[t] for t in types if t in FIELDS}
+        return params
+
+    def _node_refresh(self, dueTypes):
+        # Re-pull the attributes of each due resource on its own, returns
+        # the due types none of whose resources failed
+        failed = set()
+        for address, node in list(self.nodes.items()):
+            if address == self.address or not node.queryON:
+                continue
+            fetched = False
+            complete = True
+            for resource in node.resources():
+                if resource.type_ in dueTypes:
+                    try:
+                        resource.get_self(**self._fetch_params(resource.type_))
+                        fetched = True
+                    except (ApiError, EmptyBodyException) as ex:
+                        LOGGER.error('Error _node_refresh %s: %s', address, str(ex))
+                        failed.add(resource.type_)
+                        complete = False
+            if fetched and complete:
+                node.fetched = time.time()
+        return set(dueTypes) - failed
     
     def runDiscover(self,command):
         self.discover()
@@ -149,49 +627,342 @@ class Controller(polyinterface.Controller):
     def _discovery_process(self):
         
         try:
-            self.api_client = make_client(self.client_id,self.client_secret,'https://api.flair.co/')
-            structures = self.api_client.get('structures')
-        except ApiError as ex:
+            if self.api_client is None:
+                self.api_client = self._make_api_client()
+            if self.api_client.cache is not None:
+                # A discovery asked for by the user must see the latest topology
+                self.api_client.cache.clear()
+            topology, excluded = self._fetch_topology()
+        except (ApiError, EmptyBodyException) as ex:
             LOGGER.error('Error _discovery_process: %s', str(ex))
-            
-        for structure in structures:
-            strHash = str(int(hashlib.md5(structure.attributes['name'].encode('utf8')).hexdigest(), 16) % (10 ** 8))
-            self.addNode(FlairStructure(self, strHash, strHash,structure.attributes['name'],structure))
-            #time.sleep(5)
-            rooms = structure.get_rel('rooms')
+            return
+
+        startTime = time.time()
+        specs = self._apply_specs(self._node_specs(topology), excluded)
+        self.refresh_scheduler.mark_all()
+        LOGGER.info('Discovery nodes: %d in %.2fs', len(specs), time.time() - startTime)
+        if self.discovery_cache:
+            self._save_discovery_cache(specs)
+        if self.address_book.changed:
+            self.saveCustomDataKey('addresses', self.address_book.to_dict())
+            self.address_book.changed = False
+
+    def _make_api_client(self):
+        # Authenticates lazily on the first request
+        return Client(client_id=self.client_id,
+                      client_secret=self.client_secret,
+                      api_root=self.api_root,
+                      pool_size=self.pool_size,
+                      timeout=(self.connect_timeout,self.read_timeout),
+                      retry_policy=RetryPolicy(max_retries=self.max_retries),
+                      requests_per_minute=self.requests_per_minute,
+                      cache_size=self.response_cache,
+                      cache_ttl=self.cache_ttl,
+                      circuit_breaker=CircuitBreaker(self.breaker_threshold, self.breaker_reset, self.breaker_max_reset),
+                      # Only keep what the nodes read in long-lived resources
+                      mapper={type_: restricted_model(fields) for type_, fields in FIELDS.items()} if self.sparse_fields else {})
+
+    def _node_specs(self, topology):
+        # Node type, address, name and resources of every node, in creation order
+        known = set(self.nodes) | set(n['address'] for n in self.polyConfig.get('nodes', []))
+        book = self.address_book
+        specs = []
+        for structure, rooms in topology:
+            strAddress = book.assign(structure.type_, structure.id_, lambda: legacy_address(structure.attributes['name']), known)
+            specs.append({'node': 'FLAIR_STRUCT', 'primary': strAddress, 'address': strAddress, 'name': structure.attributes['name'], 'resource': structure, 'room': None})
             roomNumber = 1
-            for room in rooms:
-                strHashRoom = str(int(hashlib.md5(room.attributes['name'].encode('utf8')).hexdigest(), 16) % (10 ** 8))
-                self.addNode(FlairRoom(self, strHash,strHashRoom,'R' + str(roomNumber) + '_' + room.attributes['name'],room))
+            for room, pucks, vents in rooms:
+                roomAddress = book.assign(room.type_, room.id_, lambda: legacy_address(room.attributes['name']), known)
+                specs.append({'node': 'FLAIR_ROOM', 'primary': strAddress, 'address': roomAddress, 'name': 'R' + str(roomNumber) + '_' + room.attributes['name'], 'resource': room, 'room': None})
                 
-                try:
-                    pucks = room.get_rel('pucks')
-                    for puck in pucks:
-                        strHashPucks = str(int(hashlib.md5(puck.attributes['name'].encode('utf8')).hexdigest(), 16) % (10 ** 8))
-                        self.addNode(FlairPuck(self, strHash,strHashRoom[:4]+strHashPucks,'R' + str(roomNumber) + '_' + puck.attributes['name'],puck,room))
-                except EmptyBodyException as ex:
-                    pass
+                for puck in pucks:
+                    puckAddress = book.assign(puck.type_, puck.id_, lambda: legacy_address(puck.attributes['name'], room.attributes['name']), known)
+                    specs.append({'node': 'FLAIR_PUCK', 'primary': strAddress, 'address': puckAddress, 'name': 'R' + str(roomNumber) + '_' + puck.attributes['name'], 'resource': puck, 'room': room})
             
-                try:
-                    vents = room.get_rel('vents')
-                    for vent in vents :
-                        strHashVents = str(int(hashlib.md5(vent.attributes['name'].encode('utf8')).hexdigest(), 16) % (10 ** 8))
-                        self.addNode(FlairVent(self, strHash, strHashRoom[:4]+strHashVents ,'R' + str(roomNumber) + '_' + vent.attributes['name'],vent,room))
-                except EmptyBodyException as ex:
-                    pass
+                for vent in vents :
+                    ventAddress = book.assign(vent.type_, vent.id_, lambda: legacy_address(vent.attributes['name'], room.attributes['name']), known)
+                    specs.append({'node': 'FLAIR_VENT', 'primary': strAddress, 'address': ventAddress, 'name': 'R' + str(roomNumber) + '_' + vent.attributes['name'], 'resource': vent, 'room': room})
                 
                 roomNumber = roomNumber + 1
+        return specs
+
+    def _apply_specs(self, specs, excluded=()):
+        # Diffs the discovered specs against self.nodes by Flair resource id.
+        # Known nodes keep their address, live Resource and drivers, only a
+        # rename is pushed. Nodes under an excluded structure or room stop
+        # being polled. Returns the specs as they now stand.
+        existing = dict(self.nodesByResource)
+        excludedAddresses = set(existing[key].address for key in excluded if key in existing)
+
+        added = renamed = unchanged = 0
+        seen = set()
+        for spec in specs:
+            key = resource_key(spec['resource'])
+            seen.add(key)
+            if spec['room'] is not None and resource_key(spec['room']) in existing:
+                spec['room'] = existing[resource_key(spec['room'])].resources()[0]
+            node = existing.get(key)
+            if node is None:
+                node = self._make_node(spec)
+                node.fetched = time.time()
+                self.addNode(node)
+                added = added + 1
+                continue
+            spec['address'] = node.address
+            spec['primary'] = node.primary
+            spec['resource'] = node.resources()[0]
+            self.address_book.bind(key[0], key[1], node.address)
+            if not node.queryON:
+                LOGGER.info('Discovery: %s (%s) back in scope, polling it', node.address, node.name)
+                node.queryON = True
+                self.poll_scheduler.add(node.address, self._poll_cost(spec['resource']))
+            if node.name != spec['name']:
+                LOGGER.info('Discovery: renaming %s from %s to %s', node.address, node.name, spec['name'])
+                node.name = spec['name']
+                self.addNode(node)
+                renamed = renamed + 1
+            else:
+                unchanged = unchanged + 1
+
+        removed = excludedCount = 0
+        for key, node in existing.items():
+            if key in seen:
+                continue
+            room = getattr(node, 'objRoom', None)
+            if node.address in excludedAddresses or node.primary in excludedAddresses or \
+               (room is not None and resource_key(room) in excluded):
+                if self.remove_vanished:
+                    LOGGER.info('Discovery: removing %s (%s), outside the configured scope', node.address, node.name)
+                    self.delNode(node.address)
+                    removed = removed + 1
+                    continue
+                if node.queryON:
+                    LOGGER.info('Discovery: %s (%s) outside the configured scope, keeping it without polling', node.address, node.name)
+                    node.queryON = False
+                    self.poll_scheduler.remove(node.address)
+                excludedCount = excludedCount + 1
+                specs.append(self._node_spec(node))
+            elif self.remove_vanished:
+                LOGGER.info('Discovery: removing %s (%s), no longer in Flair', node.address, node.name)
+                self.delNode(node.address)
+                removed = removed + 1
+            else:
+                LOGGER.info('Discovery: %s (%s) no longer in Flair, keeping it', node.address, node.name)
+                specs.append(self._node_spec(node))
+        LOGGER.info('Discovery: %d added, %d renamed, %d removed, %d unchanged, %d out of scope', added, renamed, removed, unchanged, excludedCount)
+        return specs
+
+    def _node_spec(self, node):
+        room = getattr(node, 'objRoom', None) if node.id in ('FLAIR_PUCK', 'FLAIR_VENT') else None
+        return {'node': node.id, 'primary': node.primary, 'address': node.address, 'name': node.name, 'resource': node.resources()[0], 'room': room}
+
+    def addNode(self, node, update=False):
+        if node.address != self.address:
+            resource = node.resources()[0]
+            self.nodesByResource[resource_key(resource)] = node
+            if node.id in ('FLAIR_PUCK', 'FLAIR_VENT'):
+                self.roomDevices.setdefault(resource_key(node.objRoom), set()).add(resource_key(resource))
+            if node.queryON:
+                self.poll_scheduler.add(node.address, self._poll_cost(resource))
+        return super(Controller, self).addNode(node, update)
+
+    def _poll_cost(self, resource):
+        # A device fetch without include costs a second request for its reading
+        return 2 if not self.use_include and resource.type_ in INCLUDES else 1
+
+    def delNode(self, address):
+        if address in self.nodes and address != self.address:
+            node = self.nodes[address]
+            self.nodesByResource.pop(resource_key(node.resources()[0]), None)
+            if node.id in ('FLAIR_PUCK', 'FLAIR_VENT'):
+                self.roomDevices.get(resource_key(node.objRoom), set()).discard(resource_key(node.resources()[0]))
+            self.poll_scheduler.remove(address)
+        super(Controller, self).delNode(address)
+
+    def nodeForResource(self, type_, id_):
+        return self.nodesByResource.get((type_, id_))
+
+    def _make_node(self, spec):
+        nodeClass = NODE_CLASSES[spec['node']]
+        if spec['room'] is not None:
+            return nodeClass(self, spec['primary'], spec['address'], spec['name'], spec['resource'], spec['room'])
+        return nodeClass(self, spec['primary'], spec['address'], spec['name'], spec['resource'])
+
+    def saveCustomDataKey(self, key, value):
+        # polyConfig only catches up once Polyglot echoes the config back,
+        # keep our own copy so back to back saves don't drop each other.
+        if self.customData is None:
+            self.customData = deepcopy(self.polyConfig['customData'])
+        self.customData[key] = value
+        self.saveCustomData(self.customData)
+
+    def _save_discovery_cache(self, specs):
+        cache = []
+        for spec in specs:
+            cache.append({'node': spec['node'],
+                          'primary': spec['primary'],
+                          'address': spec['address'],
+                          'name': spec['name'],
+                          'resource': resource_to_cache(spec['resource']),
+                          'room': resource_key(spec['room']) if spec['room'] is not None else None})
+        self.saveCustomDataKey('discovery', {'version': DISCOVERY_CACHE_VERSION, 'nodes': cache})
+        LOGGER.info('Discovery cache: %d nodes saved', len(cache))
+
+    def _restore_discovery_cache(self):
+        # Rebuilds the nodes saved by the last discovery, returns True if any
+        cache = self.polyConfig['customData'].get('discovery')
+        if not cache or cache.get('version') != DISCOVERY_CACHE_VERSION:
+            return False
+        try:
+            resources = {}
+            specs = []
+            for entry in cache['nodes']:
+                resource = self.api_client.create_model(**entry['resource'])
+                resources[resource_key(resource)] = resource
+                spec = dict(entry, resource=resource)
+                if entry['room'] is not None:
+                    spec['room'] = resources[tuple(entry['room'])]
+                specs.append(spec)
+        except (KeyError, TypeError) as ex:
+            LOGGER.error('Error _restore_discovery_cache: %s', str(ex))
+            return False
+        for spec in specs:
+            self.address_book.bind(spec['resource'].type_, spec['resource'].id_, spec['address'])
+            self.addNode(self._make_node(spec))
+        LOGGER.info('Discovery cache: %d nodes restored', len(specs))
+        return True
+
+    def _fetch_topology(self):
+        # Returns ([(structure, [(room, pucks, vents), ...]), ...], excluded)
+        # in API order, excluded holds the keys of the structures and rooms
+        # left out by the scope, whose children are never fetched.
+        # Relationship fetches are spread over a bounded worker pool.
+        startTime = time.time()
+        excluded = set()
+        structures = []
+        for structure in self.api_client.get('structures').stream(prefetch=True):
+            if self.scope.structure_selected(structure):
+                structures.append(structure)
+            else:
+                excluded.add(resource_key(structure))
+        LOGGER.info('Discovery structures: %d fetched, %d out of scope in %.2fs', len(structures) + len(excluded), len(excluded), time.time() - startTime)
+
+        with ThreadPoolExecutor(max_workers=self.discovery_workers) as executor:
+            startTime = time.time()
+            roomLists = list(executor.map(lambda s: self._get_rel_list(s, 'rooms'), structures))
+            fetched = sum(len(r) for r in roomLists)
+            for roomList in roomLists:
+                excluded.update(resource_key(room) for room in roomList if not self.scope.room_selected(room))
+                roomList[:] = [room for room in roomList if self.scope.room_selected(room)]
+            if self.scope.allow_rooms:
+                # Only rooms were picked, homes without any of them are left out
+                excluded.update(resource_key(s) for s, roomList in zip(structures, roomLists) if not roomList)
+                structures = [s for s, roomList in zip(structures, roomLists) if roomList]
+                roomLists = [roomList for roomList in roomLists if roomList]
+            LOGGER.info('Discovery rooms: %d fetched, %d out of scope in %.2fs', fetched, fetched - sum(len(r) for r in roomLists), time.time() - startTime)
+
+            startTime = time.time()
+            rooms = [room for roomList in roomLists for room in roomList]
+            puckFutures = [executor.submit(self._get_rel_list, room, 'pucks') for room in rooms]
+            ventFutures = [executor.submit(self._get_rel_list, room, 'vents') for room in rooms]
+            devices = {}
+            for room, puckFuture, ventFuture in zip(rooms, puckFutures, ventFutures):
+                devices[id(room)] = (puckFuture.result(), ventFuture.result())
+            LOGGER.info('Discovery pucks/vents: %d rooms fetched in %.2fs', len(rooms), time.time() - startTime)
+
+        return ([(structure, [(room,) + devices[id(room)] for room in roomList])
+                 for structure, roomList in zip(structures, roomLists)], excluded)
+
+    def _get_rel_list(self, resource, rel):
+        try:
+            # Every page, accounts with many homes do not fit in the first
+            return list(resource.get_rel(rel).stream())
+        except EmptyBodyException:
+            return []
                            
     def delete(self):
         LOGGER.info('Deleting Flair')
         
     id = 'controller'
     commands = {    'QUERY': query,        
-                    'DISCOVERY' : runDiscover
+                    'DISCOVERY' : runDiscover,
+                    'METRICS' : logMetrics
                }
-    drivers = [{'driver': 'ST', 'value': 0, 'uom': 2}]
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 2},
+               {'driver': 'GV18', 'value': 0, 'uom': 25}]
     
-class FlairStructure(polyinterface.Node):
+class FlairNode(polyinterface.Node):
+
+    # (driver, reading, statistic) published from the reading history
+    TRENDS = []
+
+    def __init__(self, controller, primary, address, name):
+        super(FlairNode, self).__init__(controller, primary, address, name)
+        self.latestValues = {}
+        self.changed = False
+        # When the resources were last fetched, None if restored from cache
+        self.fetched = None
+        # The fetch the reading history last sampled
+        self.sampled = None
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        # Remember every value but only forward significant changes
+        self.latestValues[driver] = value
+        if not force and not self.isSignificant(driver, value):
+            return
+        # Trends and the data age drift on their own, only readings speed
+        # up adaptive polling
+        if driver != 'GV17' and not any(driver == trend[0] for trend in self.TRENDS):
+            self.changed = True
+        super(FlairNode, self).setDriver(driver, value, report, force, uom)
+
+    def isSignificant(self, driver, value):
+        for d in self.drivers:
+            if d['driver'] == driver:
+                deadband = self.controller.deadbands.get(d['uom'], 0)
+                try:
+                    if deadband > 0:
+                        return abs(float(value) - float(d['value'])) >= deadband
+                except (TypeError, ValueError):
+                    pass
+                return str(value) != str(d['value'])
+        return True
+
+    def addSamples(self, *samples):
+        # update() runs every shortPoll but the resources are only re-fetched
+        # on their own interval, sample each fetch once at its own time
+        if self.fetched is None or self.fetched == self.sampled:
+            return
+        self.sampled = self.fetched
+        for history, sample in samples:
+            history.add(sample, self.fetched)
+
+    def publishTrends(self, *histories):
+        stats = {}
+        for history in histories:
+            stats.update(history.stats())
+        for driver, reading, statistic in self.TRENDS:
+            readingStats = stats.get(reading)
+            if readingStats is None:
+                continue
+            if statistic in TREND_SCALES:
+                if readingStats['slope'] is None:
+                    continue
+                value = readingStats['slope'] * TREND_SCALES[statistic]
+            else:
+                value = readingStats[statistic]
+            self.setDriver(driver, round(value, 3))
+
+    def inactive(self):
+        # Flair flags the vents and pucks it lost contact with
+        return any(r.attributes.get('inactive') is True for r in self.resources())
+
+    def resync(self):
+        for driver, value in self.latestValues.items():
+            super(FlairNode, self).setDriver(driver, value, report=False)
+        self.reportDrivers()
+
+class FlairStructure(FlairNode):
 
     SPM = ['Home Evenness For Active Rooms Flair Setpoint','Home Evenness For Active Rooms Follow Third Party']
     HAM = ['Manual','Third Party Home Away','Flair Autohome Autoaway']
@@ -206,30 +977,38 @@ class FlairStructure(polyinterface.Node):
    
     def start(self):
         pass
+
+    def resources(self):
+        return [self.objStructure]
+
+    def refresh(self, fresh):
+        self.objStructure = fresh.get(resource_key(self.objStructure), self.objStructure)
    
     def setMode(self, command):
-        try :
-            self.objStructure.update(attributes={'mode': self.MODE[int(command.get('value'))]})  
-            self.setDriver('GV4', self.MODE.index(self.objStructure.attributes['mode']))
-        except ApiError as ex:
-            LOGGER.error('Error setMode: %s', str(ex))
+        self.setDriver('GV4', int(command.get('value')))
+        self.controller.command_queue.submit(self.objStructure, {'mode': self.MODE[int(command.get('value'))]}, self.commandDone)
        
     def setAway(self, command):
-        try:
-            self.objStructure.update(attributes={'home-away-mode': self.HAM[int(command.get('value'))]})
-            self.setDriver('GV5', self.HAM.index(self.objStructure.attributes['home-away-mode']))
-        except ApiError as ex:
-            LOGGER.error('Error setAway: %s', str(ex))
+        self.setDriver('GV5', int(command.get('value')))
+        self.controller.command_queue.submit(self.objStructure, {'home-away-mode': self.HAM[int(command.get('value'))]}, self.commandDone)
     
     def setEven(self, command):
-        try:    
-            self.objStructure.update(attributes={'set-point-mode': self.SPM[int(command.get('value'))]})
-            self.setDriver('GV6', self.SPM.index(self.objStructure.attributes['set-point-mode']))
-        except ApiError as ex:
-            LOGGER.error('Error setEven: %s', str(ex))
+        self.setDriver('GV6', int(command.get('value')))
+        self.controller.command_queue.submit(self.objStructure, {'set-point-mode': self.SPM[int(command.get('value'))]}, self.commandDone)
+
+    def commandDone(self, structure, error):
+        # Report what the API holds, the PATCH result or the old value on error
+        if error is not None:
+            LOGGER.error('Error set %s: %s', self.name, str(error))
+        else:
+            self.objStructure = structure
+        self.controller.boostPolling(self)
+        self.setDriver('GV4', self.MODE.index(self.objStructure.attributes['mode']))
+        self.setDriver('GV5', self.HAM.index(self.objStructure.attributes['home-away-mode']))
+        self.setDriver('GV6', self.SPM.index(self.objStructure.attributes['set-point-mode']))
     
     def query(self):
-        self.reportDrivers()
+        self.resync()
         
     def update(self):
         try:
@@ -262,7 +1041,8 @@ class FlairStructure(polyinterface.Node):
                 {'driver': 'GV4', 'value': 0, 'uom': 25},
                 {'driver': 'GV5', 'value': 0, 'uom': 25},
                 {'driver': 'GV6', 'value': 0, 'uom': 25},
-                {'driver': 'GV7', 'value': 0, 'uom': 17} ]
+                {'driver': 'GV7', 'value': 0, 'uom': 17},
+                {'driver': 'GV17', 'value': 0, 'uom': 58}]
     
     id = 'FLAIR_STRUCT'
     commands = {'SET_MODE' : setMode, 
@@ -270,7 +1050,7 @@ class FlairStructure(polyinterface.Node):
                 'SET_EVENESS' : setEven,
                 'QUERY': query }
    
-class FlairVent(polyinterface.Node):
+class FlairVent(FlairNode):
 
     def __init__(self, controller, primary, address, name, vent,room):
 
@@ -279,20 +1059,33 @@ class FlairVent(polyinterface.Node):
         self.name = name
         self.objVent = vent
         self.objRoom = room
+        self.history = ReadingHistory(['duct-temperature-c'], controller.history_size)
+        self.voltageHistory = ReadingHistory(['voltage'], controller.history_size, controller.voltage_interval)
         
     def start(self):
         pass
+
+    def resources(self):
+        return [self.objVent]
+
+    def refresh(self, fresh):
+        self.objVent = fresh.get(resource_key(self.objVent), self.objVent)
+        self.objRoom = fresh.get(resource_key(self.objRoom), self.objRoom)
         
     def setOpen(self, command):
-        
-        try:
-            self.objVent.update(attributes={'percent-open': int(command.get('value'))})
-            self.setDriver('GV1', self.objVent.attributes['percent-open'])
-        except ApiError as ex:
-            LOGGER.error('Error setOpen: %s', str(ex))
+        self.setDriver('GV1', int(command.get('value')))
+        self.controller.command_queue.submit(self.objVent, {'percent-open': int(command.get('value'))}, self.commandDone)
+
+    def commandDone(self, vent, error):
+        if error is not None:
+            LOGGER.error('Error setOpen: %s', str(error))
+        else:
+            self.objVent = vent
+        self.controller.boostPolling(self)
+        self.setDriver('GV1', self.objVent.attributes['percent-open'])
 
     def query(self):
-        self.reportDrivers()           
+        self.resync()
             
     def update(self):
         try:
@@ -314,6 +1107,10 @@ class FlairVent(polyinterface.Node):
             self.setDriver('GV10', tempC)
             self.setDriver('GV11', tempF)
             self.setDriver('GV12', creading.attributes['rssi'])
+
+            self.addSamples((self.history, {'duct-temperature-c': creading.attributes['duct-temperature-c']}),
+                            (self.voltageHistory, {'voltage': self.objVent.attributes['voltage']}))
+            self.publishTrends(self.history, self.voltageHistory)
         
         except ApiError as ex:
             LOGGER.error('Error query: %s', str(ex))
@@ -324,13 +1121,23 @@ class FlairVent(polyinterface.Node):
               {'driver': 'GV9', 'value': 0, 'uom': 31},
               {'driver': 'GV10', 'value': 0, 'uom': 4},
               {'driver': 'GV11', 'value': 0, 'uom': 17},
-              {'driver': 'GV12', 'value': 0, 'uom': 56}]
+              {'driver': 'GV12', 'value': 0, 'uom': 56},
+              {'driver': 'GV13', 'value': 0, 'uom': 4},
+              {'driver': 'GV14', 'value': 0, 'uom': 4},
+              {'driver': 'GV15', 'value': 0, 'uom': 4},
+              {'driver': 'GV16', 'value': 0, 'uom': 72},
+              {'driver': 'GV17', 'value': 0, 'uom': 58}]
+
+    TRENDS = [('GV13', 'duct-temperature-c', 'per_hour'),
+              ('GV14', 'duct-temperature-c', 'min'),
+              ('GV15', 'duct-temperature-c', 'max'),
+              ('GV16', 'voltage', 'per_day')]
     
     id = 'FLAIR_VENT'
     commands = { 'SET_OPEN' : setOpen,
                  'QUERY': query}
     
-class FlairPuck(polyinterface.Node):
+class FlairPuck(FlairNode):
 
     def __init__(self, controller, primary, address, name, puck,room):
 
@@ -339,12 +1146,21 @@ class FlairPuck(polyinterface.Node):
         self.name = name
         self.objPuck = puck
         self.objRoom = room
+        self.history = ReadingHistory(['current-temperature-c'], controller.history_size)
+        self.voltageHistory = ReadingHistory(['system-voltage'], controller.history_size, controller.voltage_interval)
         
     def start(self):
         pass
+
+    def resources(self):
+        return [self.objPuck]
+
+    def refresh(self, fresh):
+        self.objPuck = fresh.get(resource_key(self.objPuck), self.objPuck)
+        self.objRoom = fresh.get(resource_key(self.objRoom), self.objRoom)
     
     def query(self):
-        self.reportDrivers()
+        self.resync()
     
     def update(self):
         try:
@@ -364,6 +1180,10 @@ class FlairPuck(polyinterface.Node):
             creading = self.objPuck.get_rel('current-reading')
             self.setDriver('GV12', creading.attributes['rssi'])
             self.setDriver('GV8', creading.attributes['system-voltage'])
+
+            self.addSamples((self.history, {'current-temperature-c': self.objPuck.attributes['current-temperature-c']}),
+                            (self.voltageHistory, {'system-voltage': creading.attributes['system-voltage']}))
+            self.publishTrends(self.history, self.voltageHistory)
                
         except ApiError as ex:
             LOGGER.error('Error query: %s', str(ex))  
@@ -373,12 +1193,22 @@ class FlairPuck(polyinterface.Node):
                 {'driver': 'CLIHUM', 'value': 0, 'uom': 51},
                 {'driver': 'GV7', 'value': 0, 'uom': 17},
                 {'driver': 'GV8', 'value': 0, 'uom': 72},
-                {'driver': 'GV12', 'value': 0, 'uom': 56}]
+                {'driver': 'GV12', 'value': 0, 'uom': 56},
+                {'driver': 'GV13', 'value': 0, 'uom': 4},
+                {'driver': 'GV14', 'value': 0, 'uom': 4},
+                {'driver': 'GV15', 'value': 0, 'uom': 4},
+                {'driver': 'GV16', 'value': 0, 'uom': 72},
+                {'driver': 'GV17', 'value': 0, 'uom': 58}]
+
+    TRENDS = [('GV13', 'current-temperature-c', 'per_hour'),
+              ('GV14', 'current-temperature-c', 'min'),
+              ('GV15', 'current-temperature-c', 'max'),
+              ('GV16', 'system-voltage', 'per_day')]
     
     id = 'FLAIR_PUCK'
     commands = {  'QUERY': query }
 
-class FlairRoom(polyinterface.Node):
+class FlairRoom(FlairNode):
 
     def __init__(self, controller, primary, address, name,room):
 
@@ -386,12 +1216,19 @@ class FlairRoom(polyinterface.Node):
         self.queryON = True
         self.name = name
         self.objRoom = room
+        self.history = ReadingHistory(['current-temperature-c'], controller.history_size)
         
     def start(self):
         pass
+
+    def resources(self):
+        return [self.objRoom]
+
+    def refresh(self, fresh):
+        self.objRoom = fresh.get(resource_key(self.objRoom), self.objRoom)
     
     def query(self):
-        self.reportDrivers()
+        self.resync()
     
     def update(self):
         try:
@@ -420,28 +1257,46 @@ class FlairRoom(polyinterface.Node):
                 self.setDriver('CLISPC', round(self.objRoom.attributes['set-point-c'],1))
             else:
                 self.setDriver('CLISPC', 0)
+
+            self.addSamples((self.history, {'current-temperature-c': self.objRoom.attributes['current-temperature-c']}))
+            self.publishTrends(self.history)
          
         except ApiError as ex:
             LOGGER.error('Error query: %s', str(ex))  
     
     def setTemp(self, command):
-        try:
-            self.objRoom.update(attributes={'set-point-c': command.get('value')})
-            self.setDriver('CLISPC', round(self.objRoom.attributes['set-point-c'],1))
+        self.setDriver('CLISPC', round(float(command.get('value')),1))
+        self.controller.command_queue.submit(self.objRoom, {'set-point-c': command.get('value')}, self.commandDone)
 
-        except ApiError as ex:
-            LOGGER.error('Error setTemp: %s', str(ex))
+    def commandDone(self, room, error):
+        if error is not None:
+            LOGGER.error('Error setTemp: %s', str(error))
+        else:
+            self.objRoom = room
+        self.controller.boostPolling(self)
+        if self.objRoom.attributes['set-point-c'] is not None:
+            self.setDriver('CLISPC', round(self.objRoom.attributes['set-point-c'],1))
 
     drivers = [ {'driver': 'GV2', 'value': 0, 'uom': 2},
                 {'driver': 'CLITEMP', 'value': 0, 'uom': 4},
                 {'driver': 'CLIHUM', 'value': 0, 'uom': 51},
                 {'driver': 'CLISPC', 'value': 0, 'uom': 4},
-                {'driver': 'GV7', 'value': 0, 'uom': 17}]
+                {'driver': 'GV7', 'value': 0, 'uom': 17},
+                {'driver': 'GV13', 'value': 0, 'uom': 4},
+                {'driver': 'GV14', 'value': 0, 'uom': 4},
+                {'driver': 'GV15', 'value': 0, 'uom': 4},
+                {'driver': 'GV17', 'value': 0, 'uom': 58}]
+
+    TRENDS = [('GV13', 'current-temperature-c', 'per_hour'),
+              ('GV14', 'current-temperature-c', 'min'),
+              ('GV15', 'current-temperature-c', 'max')]
     
     id = 'FLAIR_ROOM'
     commands = { 'QUERY': query, 
                  'SET_TEMP': setTemp }    
     
+NODE_CLASSES = {nodeClass.id: nodeClass for nodeClass in [FlairStructure, FlairRoom, FlairPuck, FlairVent]}
+
 if __name__ == "__main__":
     try:
         polyglot = polyinterface.Interface('FlairNodeServer')
@@ -0,0 +1,157 @@
+import time
+from threading import Lock
+
+# Default seconds between attribute refreshes, 0 means every poll
+DEFAULT_REFRESH_INTERVALS = {
+    'structures': 600,
+    'rooms': 300,
+    'pucks': 0,
+    'vents': 0
+}
+
+
+class RefreshScheduler(object):
+    """Decides which resource types are due for an attribute refresh."""
+
+    def __init__(self, intervals=None):
+        self.intervals = dict(DEFAULT_REFRESH_INTERVALS)
+        if intervals:
+            self.intervals.update(intervals)
+        self.last_refresh = {}
+
+    def is_due(self, type_, now=None):
+        now = time.time() if now is None else now
+        last = self.last_refresh.get(type_)
+        if last is None:
+            return True
+        return now - last >= self.intervals.get(type_, 0)
+
+    def due_types(self, now=None):
+        now = time.time() if now is None else now
+        return [t for t in self.intervals if self.is_due(t, now)]
+
+    def mark(self, types, now=None):
+        now = time.time() if now is None else now
+        for type_ in types:
+            self.last_refresh[type_] = now
+
+    def mark_all(self, now=None):
+        self.mark(self.intervals.keys(), now)
+
+
+class PollState(object):
+    def __init__(self, due, interval, cost):
+        self.due = due
+        self.interval = interval
+        self.cost = cost
+        self.boost_until = 0
+
+
+class AdaptivePollScheduler(object):
+    """Per node poll intervals under a global request budget.
+
+    A node whose values changed is polled twice as often, down to
+    min_interval, and one that did not is backed off towards max_interval.
+    Inactive nodes sit at max_interval and a node that was just sent a
+    command is held at min_interval for boost seconds. First polls are
+    phased across interval so requests go out evenly, and at most budget
+    requests per minute are handed out, overdue nodes waiting their turn.
+    """
+
+    BACKOFF = 1.5
+    # Golden ratio fraction, successive nodes land evenly over the interval
+    PHASE_STEP = 0.618034
+
+    def __init__(self, interval=90, min_interval=30, max_interval=900,
+                 boost=120, budget=60):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.boost_seconds = boost
+        self.budget = budget
+        self.capacity = max(2.0, budget / 12.0)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.states = {}
+        self.phase = 0.0
+        self.lock = Lock()
+
+    def add(self, key, cost=1, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if key in self.states:
+                self.states[key].cost = cost
+                return
+            self.phase = (self.phase + self.PHASE_STEP) % 1.0
+            self.states[key] = PollState(now + self.phase * self.interval,
+                                         self.interval, cost)
+
+    def remove(self, key):
+        with self.lock:
+            self.states.pop(key, None)
+
+    def record(self, key, changed, inactive=False, now=None, failed=False):
+        """Schedules the next poll of key from the outcome of this one.
+
+        A failed poll says nothing about the values, key keeps its interval
+        and is due again right away.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                return
+            if failed:
+                state.due = now
+                return
+            if now < state.boost_until:
+                interval = self.min_interval
+            elif inactive:
+                interval = self.max_interval
+            elif changed:
+                interval = max(self.min_interval, state.interval / 2.0)
+            else:
+                interval = min(self.max_interval,
+                               state.interval * self.BACKOFF)
+            state.interval = interval
+            state.due = now + interval
+
+    def boost(self, key, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                return
+            state.boost_until = now + self.boost_seconds
+            state.interval = self.min_interval
+            state.due = min(state.due, now + self.min_interval)
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) *
+                          self.budget / 60.0)
+        self.updated = now
+
+    def due(self, now=None):
+        """Returns the keys to poll now, most overdue first."""
+        now = time.time() if now is None else now
+        with self.lock:
+            ready = sorted((s.due, k) for k, s in self.states.items()
+                           if s.due <= now)
+            if self.budget <= 0:
+                return [k for _, k in ready]
+            self._refill(now)
+            keys = []
+            for _, key in ready:
+                cost = self.states[key].cost
+                if cost > self.tokens:
+                    break
+                self.tokens -= cost
+                keys.append(key)
+            return keys
+
+    def next_due(self):
+        with self.lock:
+            if not self.states:
+                return None
+            return min(s.due for s in self.states.values())
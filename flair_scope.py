@@ -0,0 +1,44 @@
+def parse_list(value):
+    """Comma separated names or ids, compared case insensitively."""
+    return frozenset(v.strip().lower() for v in str(value or '').split(',')
+                     if v.strip())
+
+
+def matches(entries, resource):
+    return str(resource.id_).lower() in entries or \
+        str(resource.attributes.get('name', '')).strip().lower() in entries
+
+
+class TopologyScope(object):
+    """Allow and deny lists selecting the structures and rooms to import.
+
+    An empty allow list selects everything, a deny list wins over an allow
+    list. A room name selects that room in every selected structure.
+    """
+
+    def __init__(self, allow_structures='', deny_structures='',
+                 allow_rooms='', deny_rooms=''):
+        self.allow_structures = parse_list(allow_structures)
+        self.deny_structures = parse_list(deny_structures)
+        self.allow_rooms = parse_list(allow_rooms)
+        self.deny_rooms = parse_list(deny_rooms)
+
+    @property
+    def restricts_structures(self):
+        return bool(self.allow_structures or self.deny_structures)
+
+    @property
+    def restricted(self):
+        return self.restricts_structures or \
+            bool(self.allow_rooms or self.deny_rooms)
+
+    def structure_selected(self, structure):
+        if matches(self.deny_structures, structure):
+            return False
+        return not self.allow_structures or \
+            matches(self.allow_structures, structure)
+
+    def room_selected(self, room):
+        if matches(self.deny_rooms, room):
+            return False
+        return not self.allow_rooms or matches(self.allow_rooms, room)